@@ -0,0 +1,311 @@
+# Benchmarks for the REM pipeline
+# Run with: python benchmark.py [--pipeline] [--sizes 1024 4096 10240] [--output results.json]
+# The pipeline suite runs every stage on synthetic DEMs (tilted plane + noise +
+# a carved meandering channel) and writes per-stage timings as JSON, so runs
+# can be diffed to catch regressions in the hot paths.
+
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from scipy.spatial import cKDTree as KDTree
+
+import profiling
+from idw import (HAS_NUMBA, iter_tiles, idw_weights, fused_idw, idw_interpolate,
+                 idw_interpolate_parallel)
+from surface import interpolate_surface
+
+PIPELINE_SIZES = (1024, 4096, 10240)
+
+
+def synthetic_samples(n_samples=20000, extent=1.0, seed=0):
+    """Random river-like sample points and elevations"""
+    rng = np.random.default_rng(seed)
+    c_sampled = rng.uniform(0, extent, size=(n_samples, 2))
+    values = 500 + 100 * c_sampled[:, 0] + rng.normal(0, 1, n_samples)
+    return c_sampled, values
+
+
+def synthetic_channel(n_stations=5000, seed=0):
+    """Stations along a meandering channel across the unit square, with chainage"""
+    rng = np.random.default_rng(seed)
+    t = np.linspace(0, 1, n_stations)
+    stations = np.column_stack([t, 0.5 + 0.2 * np.sin(6 * np.pi * t)])
+    distance = np.concatenate([[0], np.cumsum(np.hypot(*np.diff(stations, axis=0).T))])
+    values = 500 - 100 * t + rng.normal(0, 0.1, n_stations)
+    return stations, distance, values
+
+
+def channel_centreline(t):
+    """Normalised (0-1) row position of the synthetic channel at column position t"""
+    return 0.5 + 0.15 * np.sin(2 * np.pi * 3 * t) + 0.05 * np.sin(2 * np.pi * 7 * t + 1)
+
+
+def synthetic_dem(size=1024, resolution=1.0, slope=(0.002, 0.001), noise=0.5, depth=5.0,
+                  width=0.01, seed=0, origin=(500000.0, 5000000.0), crs='EPSG:32611'):
+    """(dem, river) - a synthetic UTM DEM DataArray and its channel LineString
+
+    The DEM is a tilted plane plus Gaussian noise with a meandering channel
+    of the given depth (metres) and width (fraction of the DEM) carved into
+    it. It is built in row blocks as float32, so 10k x 10k fits in memory.
+    """
+    import xarray as xr
+    import rioxarray  # noqa: F401 - registers .rio
+    from shapely.geometry import LineString
+
+    rng = np.random.default_rng(seed)
+    x = origin[0] + (np.arange(size) + 0.5) * resolution
+    y = origin[1] - (np.arange(size) + 0.5) * resolution
+    t = np.arange(size) / (size - 1)
+    centre = channel_centreline(t)
+
+    data = np.empty((size, size), dtype=np.float32)
+    for rows, _ in iter_tiles((size, size), (512, size)):
+        v = (np.arange(rows.start, rows.stop) / (size - 1))[:, None]
+        block = 100 + slope[0] * np.arange(size) * resolution + slope[1] * v * size * resolution
+        block = block - depth * np.exp(-((v - centre) / width) ** 2)
+        block += rng.normal(0, noise, block.shape)
+        data[rows] = block
+
+    dem = xr.DataArray(data, dims=('y', 'x'), coords={'x': x, 'y': y})
+    dem = dem.rio.write_crs(crs)
+
+    n_vertices = max(size // 4, 2)
+    tv = np.linspace(0, 1, n_vertices)
+    river = LineString(np.column_stack([x[0] + tv * (x[-1] - x[0]),
+                                        y[0] + channel_centreline(tv) * (y[-1] - y[0])]))
+    return dem, river
+
+
+def _stage_results():
+    """Top-level stage records of the profiler, summed per stage name"""
+    results = {}
+    for record in profiling.records():
+        if record['depth'] != 0:
+            continue
+        total = results.setdefault(record['name'], {'calls': 0, 'seconds': 0.0, 'cpu_seconds': 0.0,
+                                                    'cells': 0, 'peak_rss_mb': 0.0})
+        total['calls'] += 1
+        total['seconds'] += record['wall']
+        total['cpu_seconds'] += record['cpu']
+        total['cells'] += record['cells'] or 0
+        total['peak_rss_mb'] = max(total['peak_rss_mb'], (record['peak_rss'] or 0) / 1024 ** 2)
+    for total in results.values():
+        total['cells_per_second'] = total['cells'] / total['seconds'] if total['cells'] else None
+    return results
+
+
+def benchmark_pipeline_size(size, k=5, tile_size=(512, 512), workdir=None):
+    """Run every pipeline stage once on a size x size synthetic DEM, returning per-stage results
+
+    The synthetic DEM is written to workdir, or to a temporary directory
+    that is removed afterwards.
+    """
+    if workdir is None:
+        with tempfile.TemporaryDirectory(prefix='rem_bench_') as tmp:
+            return benchmark_pipeline_size(size, k=k, tile_size=tile_size, workdir=tmp)
+
+    from cog import write_cog
+    from dem_io import open_raster, close_rasters, coarsen_dem
+    from hillshade import cell_size, multidirectional_hillshade_tiled
+    from render import render_rem
+    from sampling import extract_river_pixels, sample_dem, sample_river_profile
+
+    stage = profiling.stage
+    cells = size * size
+    dem, river = synthetic_dem(size)
+
+    path = os.path.join(workdir, f"dem_{size}.tif")
+    write_cog(path, dem.values, transform=dem.rio.transform(), crs=dem.rio.crs, overviews=[])
+    del dem
+
+    profiling.reset()
+
+    with stage('load', cells=cells):
+        dem = open_raster(path).squeeze().load()
+    with stage('coarsen', cells=cells):
+        coarsen_dem(dem, factor=3)
+
+    # Low cells stand in for the flow raster: the channel is the top quantile of -dem
+    with stage('river_pixels', cells=cells):
+        x_real, y_real, rows, cols = extract_river_pixels(-dem, quantile=0.99, return_indices=True)
+    with stage('sample_dem', cells=len(x_real)):
+        sample_dem(dem, x_real, y_real, source=dem, rows=rows, cols=cols)
+    with stage('sample_profile') as s:
+        sampled_x, sampled_y, values, _ = sample_river_profile(dem, river)
+        s.cells = len(values)
+
+    points = np.column_stack([sampled_x, sampled_y])
+    with stage('kdtree_build', cells=len(points)):
+        tree = KDTree(points)
+
+    # Query and weighting timed separately over the same tiles as idw.py
+    c_x, c_y = dem.x.values, dem.y.values
+    surface = np.empty((size, size), dtype=np.float32)
+    for rows, cols in iter_tiles(surface.shape, tile_size):
+        grid = np.dstack(np.meshgrid(c_x[cols], c_y[rows])).reshape(-1, 2)
+        with stage('kdtree_query', cells=len(grid)):
+            distances, indices = tree.query(grid, k=k)
+        with stage('idw_weighting', cells=len(grid)):
+            surface[rows, cols] = idw_weights(distances, values[indices]).reshape(
+                surface[rows, cols].shape)
+
+    with stage('rem_subtraction', cells=cells):
+        rem = dem.values - surface
+    del surface
+
+    with stage('hillshade', cells=cells):
+        shade = multidirectional_hillshade_tiled(dem.values, spacing=cell_size(dem))
+    with stage('render', cells=cells):
+        render_rem(rem, shade, vmin=0, vmax=10)
+
+    close_rasters()
+    os.remove(path)
+    return _stage_results()
+
+
+def benchmark_pipeline(sizes=PIPELINE_SIZES, output='benchmark_results.json', **kwargs):
+    """Per-stage benchmark of the whole pipeline at each DEM size, written to output as JSON"""
+    import platform
+
+    was_enabled = profiling.is_enabled()
+    profiling.enable()
+    results = {'python': platform.python_version(), 'numpy': np.__version__,
+               'machine': platform.machine(), 'cpus': os.cpu_count(), 'sizes': {}}
+    try:
+        for size in sizes:
+            print(f"Pipeline on a {size}x{size} synthetic DEM")
+            stages = benchmark_pipeline_size(size, **kwargs)
+            results['sizes'][str(size)] = stages
+            for name, total in stages.items():
+                rate = total['cells_per_second']
+                rate = f"{rate / 1e6:8.2f} Mcells/s" if rate else ""
+                print(f"  {name:16s} {total['seconds']:8.3f} s {rate}")
+    finally:
+        if not was_enabled:
+            profiling.disable()
+        profiling.reset()
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=1)
+        print(f"Wrote {output}")
+    return results
+
+
+def benchmark_base_surfaces(size=2048, methods=('idw', 'nearest', 'channel'),
+                            tile_size=(512, 512), repeat=3):
+    """Time and peak memory of each base-surface engine on the same channel"""
+    stations, distance, values = synthetic_channel()
+    tree = KDTree(stations)
+    c_x = np.linspace(0, 1, size)
+    c_y = np.linspace(1, 0, size)
+    options = {
+        'idw': dict(k=5, n_workers=1),
+        'nearest': {},
+        'channel': dict(stations=stations, distance=distance),
+    }
+
+    print(f"Base surface engines on a {size}x{size} grid")
+    results = []
+    for method in methods:
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            interpolate_surface(method, tree, values, c_x, c_y, tile_size=tile_size, **options[method])
+            best = min(best, time.perf_counter() - start)
+
+        tracemalloc.start()
+        interpolate_surface(method, tree, values, c_x, c_y, tile_size=tile_size, **options[method])
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        results.append({'method': method, 'seconds': best, 'peak_mb': peak / 1024 ** 2})
+        print(f"  {method:8s} {best:.3f} s  peak {peak / 1024 ** 2:.1f} MB")
+
+    return results
+
+
+def benchmark_idw_kernels(n_cells=4_000_000, k=5, powers=(1, 2), repeat=3):
+    """Time the NumPy weighting chain against the fused kernel on one query result"""
+    c_sampled, values = synthetic_samples()
+    tree = KDTree(c_sampled)
+    rng = np.random.default_rng(1)
+    distances, indices = tree.query(rng.uniform(0, 1, size=(n_cells, 2)), k=k)
+
+    if HAS_NUMBA:
+        fused_idw(distances[:10], indices[:10], values, parallel=True)  # JIT compile outside the timing
+
+    print(f"IDW weighting of {n_cells} cells x {k} neighbours "
+          f"(fused kernel: {'Numba' if HAS_NUMBA else 'NumPy fallback'})")
+    results = []
+    for power in powers:
+        timings = {}
+        for name, run in (('numpy', lambda: idw_weights(distances, values[indices], power)),
+                          ('fused', lambda: fused_idw(distances, indices, values, power, parallel=True))):
+            best = float('inf')
+            for _ in range(repeat):
+                start = time.perf_counter()
+                result = run()
+                best = min(best, time.perf_counter() - start)
+            timings[name] = (best, result)
+
+        max_error = float(np.nanmax(np.abs(timings['numpy'][1] - timings['fused'][1])))
+        speedup = timings['numpy'][0] / timings['fused'][0]
+        results.append({'power': power, 'numpy_seconds': timings['numpy'][0],
+                        'fused_seconds': timings['fused'][0], 'speedup': speedup,
+                        'max_abs_difference': max_error})
+        print(f"  power {power}: numpy {timings['numpy'][0]:.3f} s  fused {timings['fused'][0]:.3f} s  "
+              f"speedup {speedup:.2f}x  max |diff| {max_error:.2e}")
+
+    return results
+
+
+def benchmark_idw_scaling(size=2048, workers=(1, 2, 4, 8), executor='thread',
+                          tile_size=(256, 256), repeat=3):
+    """Time parallel IDW at several worker counts and check it matches serial"""
+    c_sampled, values = synthetic_samples()
+    tree = KDTree(c_sampled)
+    c_x = np.linspace(0, 1, size)
+    c_y = np.linspace(1, 0, size)
+
+    reference = idw_interpolate(tree, values, c_x, c_y, k=5, tile_size=tile_size)
+
+    print(f"IDW scaling on a {size}x{size} grid ({executor} executor)")
+    results = []
+    baseline = None
+    for n in workers:
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = idw_interpolate_parallel(tree, values, c_x, c_y, k=5, tile_size=tile_size,
+                                              n_workers=n, executor=executor)
+            best = min(best, time.perf_counter() - start)
+
+        identical = np.array_equal(result, reference)
+        baseline = baseline or best
+        results.append({'workers': n, 'seconds': best, 'speedup': baseline / best,
+                        'identical': identical})
+        print(f"  {n} workers: {best:.3f} s  speedup {baseline / best:.2f}x  identical={identical}")
+
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="REM pipeline benchmarks")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="Run only the per-stage pipeline suite on synthetic DEMs")
+    parser.add_argument('--sizes', type=int, nargs='+', default=list(PIPELINE_SIZES))
+    parser.add_argument('--output', default='benchmark_results.json')
+    args = parser.parse_args()
+
+    if not args.pipeline:
+        benchmark_idw_scaling()
+        benchmark_idw_kernels()
+        benchmark_base_surfaces()
+    benchmark_pipeline(args.sizes, output=args.output)
@@ -25,23 +25,27 @@ plt.show()
 print(f"River values range from {river_raster.min().values:.1f} to {river_raster.max().values:.1f}")
 
 
-import numpy as np
-from shapely.geometry import Point, LineString
-from sklearn.cluster import DBSCAN
-
-# Extract river pixels above a threshold (assuming higher values = river channels)
-river_threshold = river_raster.quantile(0.95)  # Top 5% of values
-river_pixels = river_raster > river_threshold
-
-# Get coordinates of river pixels
-y_coords, x_coords = np.where(river_pixels.squeeze().values)
-
-# Convert array indices to actual coordinates
-x_real = river_raster.x.values[x_coords]
-y_real = river_raster.y.values[y_coords]
+import os
 
-# Create points
-river_points = [Point(x, y) for x, y in zip(x_real, y_real)]
+import numpy as np
+from sampling import extract_river_pixels, sample_dem, sample_river_profile
+
+# Sample along the river line from coordinates.py when we have one ('profile');
+# thresholded raster pixels ('pixels') are the fallback, also for river
+# geometries that aren't lines (e.g. riverbank polygons)
+line_river = (river_geom is not None
+              and river_geom.geom_type in ('LineString', 'MultiLineString'))
+sampling_method = 'profile' if line_river else 'pixels'
+
+if sampling_method == 'profile':
+    # Points every DEM cell along the channel, smoothed to never rise downstream
+    x_real, y_real, profile_values, profile_distance = sample_river_profile(
+        dem_clipped, river_geom, spacing=None, smooth=True)
+else:
+    # Extract river pixels above a threshold (assuming higher values = river channels)
+    # Only coordinate arrays are built - pass geometry='points' if Point objects are needed
+    x_real, y_real, river_rows, river_cols = extract_river_pixels(
+        river_raster, quantile=0.95, return_indices=True)  # Top 5% of values
 
 # Convert to coordinate arrays for sampling
 xs = xr.DataArray(x_real, dims='z')
@@ -50,45 +54,156 @@ ys = xr.DataArray(y_real, dims='z')
 print(f"Extracted {len(xs)} river points")
 
 
-from sklearn.neighbors import KDTree
+from scipy.spatial import cKDTree as KDTree  # Supports workers and distance_upper_bound
+from surface import interpolate_surface
+
+if sampling_method == 'profile':
+    # Already sampled along the channel
+    sampled_x, sampled_y, sampled_values = x_real, y_real, profile_values
+else:
+    # Use dem_clipped instead of dem - river pixels on the same grid are gathered
+    # by integer index, other grids go through the DEM's affine transform
+    sampled_x, sampled_y, sampled_values = sample_dem(
+        dem_clipped, x_real, y_real, source=river_raster, rows=river_rows, cols=river_cols)
+
+# Keep only samples inside the river corridor, if one was set up in coordinates.py
+if river_corridor_mask is not None:
+    from corridor import points_in_mask
 
-# Use dem_clipped instead of dem, and make sure to squeeze it
-sampled = dem_clipped.squeeze().interp(x=xs, y=ys, method='nearest').dropna(dim='z')
+    keep = points_in_mask(river_corridor_mask, dem_clipped, sampled_x, sampled_y)
+    sampled_x, sampled_y, sampled_values = sampled_x[keep], sampled_y[keep], sampled_values[keep]
+    if sampling_method == 'profile':
+        profile_distance = profile_distance[keep]
 
-print(f"Sampled {len(sampled)} elevation values along river")
+print(f"Sampled {len(sampled_values)} elevation values along river")
 
 # Sampled river coordinates
-c_sampled = np.vstack([sampled.coords[c].values for c in ('x', 'y')]).T
+c_sampled = np.column_stack([sampled_x, sampled_y])
 
 # All (x, y) coordinates of the clipped DEM
 c_x, c_y = [dem_clipped.squeeze().coords[c].values for c in ('x', 'y')]
-c_interpolate = np.dstack(np.meshgrid(c_x, c_y)).reshape(-1, 2)
 
 # Sampled elevation values
-values = sampled.values.ravel()
+values = sampled_values.ravel()
+
+print(f"Interpolating {len(c_sampled)} sample points to {len(c_x) * len(c_y)} grid points")
+
+# Keep the samples and the interpolated surface in an on-disk store (rem_store/)
+# so later cells, reruns after a kernel restart and worker processes can
+# reopen them memory-mapped instead of recomputing
+from store import ArrayStore, source_fingerprints
+
+array_store = ArrayStore("rem_store")
+sample_sources = source_fingerprints(c_sampled=c_sampled, values=values, x=c_x, y=c_y)
+array_store.put('c_sampled', c_sampled, sources=sample_sources)
+array_store.put('values', values, sources=sample_sources)
 
-print(f"Interpolating {len(c_sampled)} sample points to {len(c_interpolate)} grid points")
+# Optionally reuse the KDTree and the neighbour queries of earlier runs with the
+# same samples and grid (stored in ~/.cache/rem/knn) - sweeping k (up to the
+# cached k), max_distance or idw_power then only redoes the weighting. Off by
+# default: it writes the whole grid's neighbours to disk instead of running
+# the tiled, parallel in-memory IDW
+use_knn_cache = False
 
 # Build KDTree
-tree = KDTree(c_sampled)
+from profiling import stage
+
+with stage('build_kdtree', samples=len(c_sampled)):
+    if use_knn_cache:
+        from knn_cache import cached_tree, cached_neighbours, idw_from_neighbours
+        tree = cached_tree(c_sampled)
+    else:
+        tree = KDTree(c_sampled)
+
+# Base surface engine: 'idw' (5-neighbour inverse distance weighting), 'nearest'
+# (elevation of the nearest river station) or 'channel' (nearest station
+# blended along the channel - needs the 'profile' sampling above)
+surface_method = 'idw'
+
+# Work through the grid one tile at a time, spread over all CPU cores for IDW
+# (n_workers=1 runs the serial path)
+n_workers = None
+
+# Optional search radius (in DEM units) and valley-corridor mask - cells
+# outside them are skipped and left as NaN
+max_distance = None
+valley_mask = river_corridor_mask
+
+# IDW power (1 = classic inverse distance) and weighting kernel: 'numpy', or
+# 'fused' for the single-pass kernel (Numba-compiled when installed)
+idw_power = 1
+idw_kernel = 'numpy'
+
+if surface_method == 'idw':
+    surface_options = dict(k=5, n_workers=n_workers, executor='thread', power=idw_power,
+                           kernel=idw_kernel)
+elif surface_method == 'channel':
+    surface_options = dict(stations=c_sampled, distance=profile_distance)
+else:
+    surface_options = {}
 
-# IWD interpolation - query 5 nearest neighbors
-distances, indices = tree.query(c_interpolate, k=5)
+# Incremental mode: keep the surface and REM of the last build in this
+# directory and, when the river samples change, only recompute the grid blocks
+# whose nearest samples changed and patch them into rem.tif and
+# river_elevation.tif (None always runs the full build, as does any change of
+# grid, mask or IDW parameters)
+rem_state_dir = None
+rem_outputs = ("rem.tif", "river_elevation.tif")
 
-# Calculate inverse distance weights
-weights = 1 / (distances + 1e-10)  # Add small value to avoid division by zero
-weights = weights / weights.sum(axis=1).reshape(-1, 1)
+if rem_state_dir is not None and surface_method == 'idw':
+    from incremental import state_matches
 
-# Interpolate values
-interpolated_values = (weights * values[indices]).sum(axis=1)
+    incremental_update = state_matches(rem_state_dir, c_x, c_y, k=5, max_distance=max_distance,
+                                       mask=valley_mask, power=idw_power, kernel=idw_kernel)
+else:
+    incremental_update = False
+outputs_patched = incremental_update and all(os.path.exists(path) for path in rem_outputs)
+
+surface_sources = dict(sample_sources, **source_fingerprints(
+    params=dict(method=surface_method, k=5, max_distance=max_distance, power=idw_power,
+                kernel=idw_kernel),
+    mask=valley_mask if valley_mask is not None else 'none',
+))
+stored_surface = None if incremental_update else array_store.get('elevation_raster',
+                                                                  sources=surface_sources)
+
+if stored_surface is not None:
+    interpolated_values = stored_surface
+    print("Reusing the stored interpolated surface")
+elif incremental_update:
+    from incremental import incremental_rem, load_state
+
+    updated_tiles = incremental_rem(rem_state_dir, dem_clipped, c_sampled, values, c_x, c_y, k=5,
+                                    tile_size=(512, 512), max_distance=max_distance,
+                                    mask=valley_mask, power=idw_power, kernel=idw_kernel,
+                                    rem_path=rem_outputs[0] if outputs_patched else None,
+                                    elevation_path=rem_outputs[1] if outputs_patched else None)
+    _, _, _, interpolated_values, rem_values = load_state(rem_state_dir)
+    print(f"Incremental update: recomputed {len(updated_tiles)} blocks")
+elif surface_method == 'idw' and use_knn_cache:
+    distances, indices = cached_neighbours(tree, c_x, c_y, k=5, workers=n_workers or -1,
+                                           mask=valley_mask)
+    interpolated_values = idw_from_neighbours(distances, indices, values, (len(c_y), len(c_x)),
+                                              k=5, max_distance=max_distance, mask=valley_mask,
+                                              power=idw_power, kernel=idw_kernel)
+else:
+    interpolated_values = interpolate_surface(surface_method, tree, values, c_x, c_y,
+                                              tile_size=(512, 512), max_distance=max_distance,
+                                              mask=valley_mask, **surface_options)
 
 # Create DataArray from interpolated values
 elevation_raster = xr.DataArray(
-    interpolated_values.reshape((len(c_y), len(c_x))), 
+    interpolated_values, 
     dims=('y', 'x'), 
     coords={'x': c_x, 'y': c_y}
 )
 
+# Stored once with its CRS and transform - the interpolated values and the
+# elevation raster are the same array
+if stored_surface is None:
+    array_store.put('elevation_raster', elevation_raster, sources=surface_sources,
+                    crs=dem_clipped.rio.crs, transform=dem_clipped.rio.transform())
+
 print(f"Created elevation raster with shape: {elevation_raster.shape}")
 
 # Plot the interpolated elevation raster
@@ -0,0 +1,182 @@
+# Cloud-optimized GeoTIFF writer for REM rasters
+# The raster is written block by block into a tiled GeoTIFF, overviews are
+# built from it and the result is copied into COG layout, so the full array
+# never has to be in memory.
+
+import os
+import tempfile
+import warnings
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.shutil import copy as rio_copy
+from rasterio.windows import Window
+
+from idw import iter_tiles
+from profiling import profiled
+
+INT16_NODATA = -32768
+INT16_MAX = np.iinfo(np.int16).max
+DEFAULT_SCALE = 0.01  # Centimetres, when the value range fits
+
+
+def overview_factors(shape, block_size=512):
+    """Overview decimation factors (2, 4, 8, ...) down to about one block"""
+    factors = []
+    factor = 2
+    while max(shape) / factor >= block_size / 2:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def int16_scaling(vmin, vmax):
+    """(scale, offset) fitting [vmin, vmax] into int16 - centimetres when the range allows"""
+    if not (np.isfinite(vmin) and np.isfinite(vmax)):
+        return DEFAULT_SCALE, 0.0
+    offset = float(np.round((vmin + vmax) / 2, 2))
+    half_span = max(vmax - offset, offset - vmin)
+    scale = max(DEFAULT_SCALE, half_span / (INT16_MAX - 1))
+    return float(scale), offset
+
+
+def encode_block(block, encoding='float32', scale=None, offset=None, nodata=None):
+    """Encode a float block as float32, or as int16 = round((value - offset) / scale)
+
+    Without scale/offset they are derived from the block's own range (see
+    int16_scaling); values that still don't fit are clipped with a warning.
+    """
+    block = np.asarray(block, dtype=np.float32)
+    if nodata is not None:
+        block = np.where(block == nodata, np.nan, block)
+
+    if encoding == 'float32':
+        return block
+
+    if encoding == 'int16':
+        if scale is None or offset is None:
+            derived = int16_scaling(*_nan_range(block))
+            scale = derived[0] if scale is None else scale
+            offset = derived[1] if offset is None else offset
+        with np.errstate(invalid='ignore'):
+            encoded = np.round((block - offset) / scale)
+            clipped = np.count_nonzero((encoded < INT16_NODATA + 1) | (encoded > INT16_MAX))
+        if clipped:
+            warnings.warn(f"{clipped} values outside the int16 range of scale={scale}, "
+                          f"offset={offset} were clipped")
+        encoded = np.clip(encoded, INT16_NODATA + 1, INT16_MAX)
+        return np.where(np.isnan(encoded), INT16_NODATA, encoded).astype(np.int16)
+
+    raise ValueError(f"Unknown encoding: {encoding!r} (use 'float32' or 'int16')")
+
+
+def _nan_range(block):
+    """(min, max) ignoring NaN, (nan, nan) for an all-NaN block"""
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return float(np.nanmin(block)), float(np.nanmax(block))
+
+
+def _read_block(source, rows, cols):
+    """One block of a DataArray, array or callable(rows, cols) source"""
+    if callable(source):
+        return source(rows, cols)
+    block = source[..., rows, cols]
+    return np.asarray(getattr(block, 'values', block)).squeeze()
+
+
+@profiled('write_cog')
+def write_cog(path, source, transform=None, crs=None, encoding='float32', scale=None,
+              offset=None, block_size=512, overviews=None, compress='DEFLATE', nodata=None,
+              resampling=Resampling.average):
+    """Write a single-band raster to a cloud-optimized GeoTIFF
+
+    source     -- 2-D DataArray (lazy/Dask-backed is fine), NumPy array, or a
+                  callable(rows, cols) returning that block, e.g. one that
+                  computes the REM block on the fly
+    transform  -- defaults to source.rio.transform() for DataArrays
+    crs        -- defaults to source.rio.crs for DataArrays
+    encoding   -- 'float32', or 'int16' scaled by scale/offset (stored in
+                  the file so readers can unscale); when they are not given
+                  they are fitted to the raster's min/max
+    overviews  -- decimation factors, defaults to 2, 4, 8, ... down to a block
+    nodata     -- input value to treat as missing
+    """
+    if callable(source):
+        shape = source.shape
+    else:
+        shape = source.shape[-2:]
+        if transform is None:
+            transform = source.rio.transform()
+        if crs is None:
+            crs = source.rio.crs
+
+    if overviews is None:
+        overviews = overview_factors(shape, block_size)
+
+    if encoding == 'int16' and (scale is None or offset is None):
+        # One scale/offset for the whole file, from a pass over its blocks
+        vmin, vmax = np.inf, -np.inf
+        for rows, cols in iter_tiles(shape, (block_size, block_size)):
+            block = encode_block(_read_block(source, rows, cols), 'float32', nodata=nodata)
+            block_min, block_max = _nan_range(block)
+            if np.isfinite(block_min):
+                vmin, vmax = min(vmin, block_min), max(vmax, block_max)
+        derived = int16_scaling(vmin, vmax)
+        scale = derived[0] if scale is None else scale
+        offset = derived[1] if offset is None else offset
+
+    profile = {
+        'driver': 'GTiff',
+        'height': shape[0],
+        'width': shape[1],
+        'count': 1,
+        'dtype': 'int16' if encoding == 'int16' else 'float32',
+        'nodata': INT16_NODATA if encoding == 'int16' else np.nan,
+        'crs': crs,
+        'transform': transform,
+        'tiled': True,
+        'blockxsize': block_size,
+        'blockysize': block_size,
+        'compress': compress,
+        'BIGTIFF': 'IF_SAFER',
+    }
+
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(suffix='.tif', dir=directory, delete=False) as tmp:
+        tmp_path = tmp.name
+
+    try:
+        with rasterio.open(tmp_path, 'w', **profile) as dst:
+            for rows, cols in iter_tiles(shape, (block_size, block_size)):
+                block = encode_block(_read_block(source, rows, cols), encoding, scale, offset, nodata)
+                window = Window(cols.start, rows.start, cols.stop - cols.start, rows.stop - rows.start)
+                dst.write(block, 1, window=window)
+
+            if encoding == 'int16':
+                dst.scales = (scale,)
+                dst.offsets = (offset,)
+            if overviews:
+                dst.build_overviews(overviews, resampling)
+
+        # Re-layout as COG, reusing the overviews built above
+        rio_copy(tmp_path, str(path), driver='COG', compress=compress, blocksize=block_size,
+                 overviews='FORCE_USE_EXISTING' if overviews else 'NONE',
+                 BIGTIFF='IF_SAFER')
+    finally:
+        os.remove(tmp_path)
+
+    return path
+
+
+def difference_source(dem, surface):
+    """callable(rows, cols) computing dem - surface one block at a time"""
+    dem = dem.squeeze()
+
+    def block(rows, cols):
+        return (np.asarray(dem[rows, cols].values, dtype=np.float32) -
+                np.asarray(surface[rows, cols], dtype=np.float32))
+
+    block.shape = dem.shape
+    return block
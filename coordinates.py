@@ -11,12 +11,10 @@ else:
 
 dem = dem.sel(y=slice(ymax, ymin), x=slice(xmin, xmax))
 
-import rasterio
-import xarray as xr
-import rioxarray as rxr
+from dem_io import open_raster, clip_window
 
-# Load the river TIFF as raster data
-river_raster = rxr.open_rasterio("/content/USGS_1_n52w119_20130911.tif")
+# Load the river TIFF as raster data (lazily - nothing is read until needed)
+river_raster = open_raster("/content/USGS_1_n52w119_20130911.tif")
 
 # Check what's in the river raster
 print("River raster info:")
@@ -39,7 +37,8 @@ print(f"Unique values: {len(river_raster.values[~np.isnan(river_raster.values)])
 
 # First, load your DEM data
 # Replace "your_dem_file.tif" with your actual DEM filename
-dem = rxr.open_rasterio("/content/USGS_1_n52w119_20130911.tif")
+# The same path returns the already-open handle instead of reopening the file
+dem = open_raster("/content/USGS_1_n52w119_20130911.tif")
 
 # Use the river bounds to clip the DEM
 river_bounds = river_raster.rio.bounds()
@@ -52,8 +51,20 @@ ymax = river_bounds[3] + buffer
 
 print(f"Clipping DEM with bounds: {xmin}, {ymin}, {xmax}, {ymax}")
 
-# Clip DEM to match river area
-dem_clipped = dem.sel(x=slice(xmin, xmax), y=slice(ymax, ymin))
+# Clip DEM to match river area - only the blocks inside the window are read
+dem_clipped = clip_window(dem, river_bounds, buffer=buffer).load()
+
+# Optional river corridor: buffer the river by this many metres and only read
+# and process the DEM cells inside it (None keeps the full bounding box)
+corridor_distance = None
+river_corridor_mask = None
+
+if corridor_distance is not None and river_geom is not None:
+    from corridor import load_corridor, mask_fraction
+
+    dem_clipped, river_corridor_mask = load_corridor(dem, river, corridor_distance)
+    dem_clipped = dem_clipped.load()
+    print(f"River corridor covers {mask_fraction(river_corridor_mask):.0%} of its bounding box")
 
 print(f"DEM clipped shape: {dem_clipped.shape}")
 print(f"DEM has data: {not dem_clipped.isnull().all()}")
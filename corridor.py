@@ -0,0 +1,54 @@
+# River-corridor windowing
+# Buffers the river geometry, reads only the DEM window around that buffer and
+# rasterises it into a mask, so sampling, IDW and rendering can skip the
+# upland cells a plain bounding box would include.
+
+import numpy as np
+from rasterio.features import geometry_mask
+
+from dem_io import clip_window
+from sampling import xy_to_index
+
+
+def river_corridor(river, distance):
+    """River geometry buffered by distance (metres), as one shapely geometry in river's CRS
+
+    Geographic CRSs are buffered in the local UTM zone so distance is
+    always metric.
+    """
+    if river.crs is not None and river.crs.is_geographic:
+        utm = river.estimate_utm_crs()
+        return river.to_crs(utm).buffer(distance).to_crs(river.crs).union_all()
+    return river.buffer(distance).union_all()
+
+
+def corridor_mask(corridor, raster):
+    """Boolean (y, x) mask of raster cells whose centre lies inside the corridor"""
+    shape = raster.squeeze().shape[-2:]
+    return geometry_mask([corridor], out_shape=shape, transform=raster.rio.transform(),
+                         invert=True)
+
+
+def load_corridor(dem, river, distance):
+    """(dem_window, mask) for the river corridor
+
+    Only the corridor's bounding box is read from the DEM; mask marks the
+    cells inside the buffered river.
+    """
+    corridor = river_corridor(river, distance)
+    dem_window = clip_window(dem, corridor.bounds)
+    return dem_window, corridor_mask(corridor, dem_window)
+
+
+def points_in_mask(mask, raster, x, y):
+    """Boolean array: which (x, y) points fall on True cells of mask"""
+    rows, cols = xy_to_index(raster, np.asarray(x), np.asarray(y))
+    inside = (rows >= 0) & (rows < mask.shape[0]) & (cols >= 0) & (cols < mask.shape[1])
+    keep = np.zeros(len(rows), dtype=bool)
+    keep[inside] = mask[rows[inside], cols[inside]]
+    return keep
+
+
+def mask_fraction(mask):
+    """Share of cells inside the corridor"""
+    return float(np.count_nonzero(mask)) / mask.size if mask.size else 0.0
@@ -1,3 +1,7 @@
-dem = rioxarray.open_rasterio("/content/USGS_1_n52w119_20130911.tif")
-dem = dem.coarsen(x=3, boundary='trim').mean().coarsen(y=3, boundary='trim').mean()
+from dem_io import open_raster, coarsen_dem
+
+# Opened lazily and shared with the river raster in coordinates.py
+dem = open_raster("/content/USGS_1_n52w119_20130911.tif")
+# Single-pass 3x3 block mean (NaN and nodata aware)
+dem = coarsen_dem(dem, factor=3, how='mean')
 dem.squeeze().plot.imshow()
@@ -0,0 +1,143 @@
+# Lazy, windowed DEM loading and downsampling
+# Rasters are opened once per path and shared, backed by Dask chunks when Dask
+# is installed, so clipping to a bounding box only reads the blocks inside it.
+
+import warnings
+
+import numpy as np
+import rioxarray
+import xarray as xr
+
+from profiling import profiled
+
+try:
+    import dask  # noqa: F401 - only needed for chunked loading
+    HAS_DASK = True
+except ImportError:
+    HAS_DASK = False
+
+DEFAULT_CHUNKS = {'band': 1, 'x': 1024, 'y': 1024}
+
+# Open rasters, keyed by (path, chunks)
+_open_rasters = {}
+
+
+@profiled('open_raster')
+def open_raster(path, chunks=DEFAULT_CHUNKS, masked=False):
+    """Open a raster lazily, reusing the handle if the path is already open
+
+    Without Dask installed the raster is still lazy (rioxarray only reads
+    the window that is indexed), just not chunked.
+    """
+    if not HAS_DASK:
+        chunks = None
+
+    key = (str(path), tuple(sorted(chunks.items())) if chunks else None, masked)
+    if key not in _open_rasters:
+        _open_rasters[key] = rioxarray.open_rasterio(path, chunks=chunks, masked=masked,
+                                                     cache=False, lock=False)
+    return _open_rasters[key]
+
+
+def close_rasters():
+    """Close every raster opened through open_raster"""
+    for raster in _open_rasters.values():
+        raster.close()
+    _open_rasters.clear()
+
+
+def clip_window(raster, bounds, buffer=0.0):
+    """Lazily clip a raster to (xmin, ymin, xmax, ymax) plus a buffer"""
+    xmin, ymin, xmax, ymax = bounds
+    return raster.rio.clip_box(
+        minx=xmin - buffer, miny=ymin - buffer,
+        maxx=xmax + buffer, maxy=ymax + buffer,
+    )
+
+
+def load_window(path, bounds, buffer=0.0, chunks=DEFAULT_CHUNKS, masked=False, load=True):
+    """Read only the (buffered) bounding box of a raster
+
+    With load=False the clipped array is returned still lazy.
+    """
+    window = clip_window(open_raster(path, chunks=chunks, masked=masked), bounds, buffer)
+    return window.load() if load else window
+
+
+# -----------------------------------------------------------------------------
+# Downsampling
+# -----------------------------------------------------------------------------
+
+BLOCK_REDUCERS = {
+    'mean': np.nanmean,
+    'min': np.nanmin,
+    'max': np.nanmax,
+    'median': np.nanmedian,
+}
+
+
+def block_reduce(data, factors, how='mean', nodata=None):
+    """Reduce the last two axes of data by (fy, fx) blocks in a single pass
+
+    Edges that don't fill a whole block are trimmed. NaN cells, and cells
+    equal to nodata, are ignored; all-empty blocks become NaN.
+    """
+    fy, fx = factors
+    ny = data.shape[-2] // fy * fy
+    nx = data.shape[-1] // fx * fx
+    data = data[..., :ny, :nx]
+
+    if nodata is not None or not np.issubdtype(data.dtype, np.floating):
+        data = data.astype(np.float32 if data.dtype.itemsize <= 4 else np.float64)
+        if nodata is not None:
+            data[data == nodata] = np.nan
+
+    # Block view: (..., rows, fy, cols, fx) - no copy for the trimmed input
+    blocks = data.reshape(data.shape[:-2] + (ny // fy, fy, nx // fx, fx))
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)  # All-NaN blocks
+        return BLOCK_REDUCERS[how](blocks, axis=(-3, -1))
+
+
+def factor_for_resolution(raster, target_resolution):
+    """Integer (fy, fx) coarsening factors closest to a target cell size"""
+    xres, yres = raster.rio.resolution()
+    return (max(1, int(round(target_resolution / abs(yres)))),
+            max(1, int(round(target_resolution / abs(xres)))))
+
+
+@profiled('coarsen_dem', cells=lambda out: out.size)
+def coarsen_dem(dem, factor=3, how='mean', target_resolution=None, nodata=None):
+    """Downsample a DEM with one 2-D block reduction
+
+    factor            -- int, or (fy, fx) per axis
+    how               -- 'mean', 'min', 'max' or 'median'
+    target_resolution -- pick the factor for this output cell size instead
+    nodata            -- value to ignore (defaults to the raster's nodata)
+    """
+    if target_resolution is not None:
+        factors = factor_for_resolution(dem, target_resolution)
+    elif isinstance(factor, int):
+        factors = (factor, factor)
+    else:
+        factors = tuple(factor)
+
+    if nodata is None:
+        nodata = dem.rio.nodata
+
+    reduced = block_reduce(np.asarray(dem.values), factors, how=how, nodata=nodata)
+
+    # Block-centre coordinates
+    fy, fx = factors
+    c_y = dem.y.values[:reduced.shape[-2] * fy].reshape(-1, fy).mean(axis=1)
+    c_x = dem.x.values[:reduced.shape[-1] * fx].reshape(-1, fx).mean(axis=1)
+
+    coords = {name: dem.coords[name].values for name in dem.dims[:-2]}
+    coords.update(y=c_y, x=c_x)
+    coarse = xr.DataArray(reduced, dims=dem.dims, coords=coords, attrs=dem.attrs)
+    coarse = coarse.rio.write_crs(dem.rio.crs)
+    if nodata is not None:
+        coarse = coarse.rio.write_nodata(np.nan)
+
+    return coarse
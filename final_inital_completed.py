@@ -1,11 +1,16 @@
-import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.colors import LinearSegmentedColormap
 
 # Your beautiful color palette
 colors = ['#f2f7fb', '#81a8cb', '#37123d']
 
-print(f"REM data range: {rem.min().values:.2f} to {rem.max().values:.2f}")
+# One pass over the REM gives min/max/mean/std and every percentile below
+from rem_stats import raster_stats
+
+stats = raster_stats(rem)
+rem_min, rem_max = stats.min, stats.max
+
+print(f"REM data range: {rem_min:.2f} to {rem_max:.2f}")
 print(f"DEM data range: {dem.min().values:.2f} to {dem.max().values:.2f}")
 
 # =============================================================================
@@ -20,7 +25,7 @@ try:
     
     # Fix the REM span to use actual data range
     b = shade(rem.squeeze(), cmap=colors, 
-              span=[rem.min().values, rem.max().values], how='linear', alpha=200)
+              span=[rem_min, rem_max], how='linear', alpha=200)
     
     # Stack them
     combined = stack(a, b)
@@ -36,28 +41,14 @@ except NameError as e:
 print("\n=== Option 2: Matplotlib implementation ===")
 
 # Create hillshade effect manually
-def simple_hillshade(dem_data, azimuth=315, altitude=45):
-    """Simple hillshade calculation"""
-    # Calculate gradients
-    dy, dx = np.gradient(dem_data)
-    
-    # Convert to radians
-    azimuth_rad = np.radians(azimuth)
-    altitude_rad = np.radians(altitude)
-    
-    # Calculate slope and aspect
-    slope = np.arctan(np.sqrt(dx**2 + dy**2))
-    aspect = np.arctan2(-dx, dy)
-    
-    # Calculate hillshade
-    hillshade = np.sin(altitude_rad) * np.sin(slope) + \
-                np.cos(altitude_rad) * np.cos(slope) * \
-                np.cos(azimuth_rad - aspect)
-    
-    return np.clip(hillshade, 0, 1)
+# Slope/aspect terms are computed once per DEM (using its real cell size) and
+# reused for every lighting angle below
+from hillshade import shading_terms, hillshade, cell_size
+
+hillshade_terms = shading_terms(dem.values.squeeze(), spacing=cell_size(dem))
 
 # Create hillshade
-hillshade_data = simple_hillshade(dem.values.squeeze(), azimuth=310, altitude=1)
+hillshade_data = hillshade(hillshade_terms, azimuth=310, altitude=1)
 
 # Create the combined visualization
 fig, axes = plt.subplots(2, 2, figsize=(16, 14))
@@ -70,7 +61,7 @@ axes[0,0].axis('off')
 # 2. REM only with correct range
 custom_cmap = LinearSegmentedColormap.from_list("custom", colors)
 rem_img = axes[0,1].imshow(rem.values.squeeze(), cmap=custom_cmap, 
-                          vmin=rem.min().values, vmax=rem.max().values, alpha=0.8)
+                          vmin=rem_min, vmax=rem_max, alpha=0.8)
 axes[0,1].set_title('REM (Actual Range)')
 axes[0,1].axis('off')
 plt.colorbar(rem_img, ax=axes[0,1], fraction=0.046, pad=0.04)
@@ -78,14 +69,14 @@ plt.colorbar(rem_img, ax=axes[0,1], fraction=0.046, pad=0.04)
 # 3. Combined - hillshade + REM (actual range)
 axes[1,0].imshow(hillshade_data, cmap='gray', alpha=0.7)
 rem_overlay = axes[1,0].imshow(rem.values.squeeze(), cmap=custom_cmap, 
-                              vmin=rem.min().values, vmax=rem.max().values, 
+                              vmin=rem_min, vmax=rem_max, 
                               alpha=0.6)
 axes[1,0].set_title('Combined: Hillshade + REM (Actual Range)')
 axes[1,0].axis('off')
 plt.colorbar(rem_overlay, ax=axes[1,0], fraction=0.046, pad=0.04)
 
 # 4. Combined - hillshade + REM (upper range focus)
-upper_percentile = np.percentile(rem.values, 85)
+upper_percentile = stats.percentile(85)
 axes[1,1].imshow(hillshade_data, cmap='gray', alpha=0.7)
 rem_upper = axes[1,1].imshow(rem.values.squeeze(), cmap=custom_cmap, 
                             vmin=upper_percentile, vmax=0, alpha=0.6)
@@ -114,12 +105,12 @@ for i, (azimuth, altitude, title) in enumerate(angles):
     row, col = i // 2, i % 2
     
     # Create hillshade
-    hs = simple_hillshade(dem.values.squeeze(), azimuth=azimuth, altitude=altitude)
+    hs = hillshade(hillshade_terms, azimuth=azimuth, altitude=altitude)
     
     # Combine with REM
     axes[row, col].imshow(hs, cmap='gray', alpha=0.7)
     rem_img = axes[row, col].imshow(rem.values.squeeze(), cmap=custom_cmap, 
-                                   vmin=rem.min().values, vmax=rem.max().values, 
+                                   vmin=rem_min, vmax=rem_max, 
                                    alpha=0.6)
     axes[row, col].set_title(f'Hillshade + REM: {title}')
     axes[row, col].axis('off')
@@ -128,17 +119,36 @@ plt.suptitle('Different Hillshade Lighting Conditions', fontsize=16)
 plt.tight_layout()
 plt.show()
 
+# =============================================================================
+# Option 4: Multidirectional hillshade - one render instead of four
+# =============================================================================
+print("\n=== Option 4: Multidirectional hillshade ===")
+from hillshade import multidirectional_hillshade
+
+# Azimuths blended per cell by aspect, reusing the cached slope/aspect terms
+# (use multidirectional_hillshade_tiled for rasters that don't fit in memory)
+md_hillshade = multidirectional_hillshade(hillshade_terms, azimuths=(225, 270, 315, 360), altitude=45)
+
+fig, ax = plt.subplots(figsize=(12, 10))
+ax.imshow(md_hillshade, cmap='gray', alpha=0.7)
+ax.imshow(rem.values.squeeze(), cmap=custom_cmap, 
+          vmin=rem_min, vmax=rem_max, alpha=0.6)
+ax.set_title('Hillshade + REM: Multidirectional')
+ax.axis('off')
+plt.tight_layout()
+plt.show()
+
 # =============================================================================
 # Corrected versions of your original code
 # =============================================================================
 print("\n=== Corrected versions for your xrspatial code ===")
 print("# Version 1: Use actual REM range")
 print("a = shade(xrspatial.hillshade(dem.squeeze(), angle_altitude=1, azimuth=310), cmap=['black', 'white'], how='linear')")
-print(f"b = shade(rem.squeeze(), cmap={colors}, span=[{rem.min().values:.2f}, {rem.max().values:.2f}], how='linear', alpha=200)")
+print(f"b = shade(rem.squeeze(), cmap={colors}, span=[{rem_min:.2f}, {rem_max:.2f}], how='linear', alpha=200)")
 print("stack(a, b)")
 
 print("\n# Version 2: Focus on upper REM values")
-upper_bound = np.percentile(rem.values, 90)
+upper_bound = stats.percentile(90)
 print("a = shade(xrspatial.hillshade(dem.squeeze(), angle_altitude=1, azimuth=310), cmap=['black', 'white'], how='linear')")
 print(f"b = shade(rem.squeeze(), cmap={colors}, span=[{upper_bound:.2f}, 0.0], how='linear', alpha=200)")
 print("stack(a, b)")
@@ -151,6 +161,11 @@ print("stack(a, b)")
 
 # Show data ranges for reference
 print(f"\nData Reference:")
-print(f"REM range: {rem.min().values:.2f} to {rem.max().values:.2f}")
-print(f"REM 90th percentile: {np.percentile(rem.values, 90):.2f}")
+print(f"REM range: {rem_min:.2f} to {rem_max:.2f}")
+print(f"REM 90th percentile: {stats.percentile(90):.2f}")
 print(f"DEM range: {dem.min().values:.2f} to {dem.max().values:.2f}")
+
+# Production render: multidirectional hillshade + REM, written straight to PNG
+from render import render_rem_image
+
+render_rem_image("rem_hillshade.png", rem, hillshade=md_hillshade, vmin=rem_min, vmax=rem_max, alpha=200)
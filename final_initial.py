@@ -1,4 +1,3 @@
-import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.colors import LinearSegmentedColormap
 
@@ -8,14 +7,20 @@ colors = ['#f2f7fb', '#81a8cb', '#37123d']
 # Create a custom colormap
 custom_cmap = LinearSegmentedColormap.from_list("custom", colors)
 
+# One pass over the REM gives min/max/mean/std and every percentile below
+from rem_stats import raster_stats
+
+stats = raster_stats(rem)
+rem_min, rem_max = stats.min, stats.max
+
 # Check your data range
-print(f"REM data range: {rem.min().values:.2f} to {rem.max().values:.2f}")
+print(f"REM data range: {rem_min:.2f} to {rem_max:.2f}")
 
 # Option 1: Use the actual data range
 print("\n=== Option 1: Visualizing with actual data range ===")
 plt.figure(figsize=(12, 10))
 im1 = plt.imshow(rem.squeeze(), cmap=custom_cmap, 
-                 vmin=rem.min().values, vmax=rem.max().values)
+                 vmin=rem_min, vmax=rem_max)
 plt.colorbar(im1, label='REM Values')
 plt.title('REM Visualization - Full Range')
 plt.axis('off')
@@ -24,7 +29,7 @@ plt.show()
 
 # Option 2: Focus on a specific range (e.g., upper values)
 print("\n=== Option 2: Focusing on upper range ===")
-upper_percentile = np.percentile(rem.values, 90)  # Top 10% of values
+upper_percentile = stats.percentile(90)  # Top 10% of values
 plt.figure(figsize=(12, 10))
 im2 = plt.imshow(rem.squeeze(), cmap=custom_cmap, 
                  vmin=upper_percentile, vmax=0)
@@ -37,7 +42,7 @@ plt.show()
 # Option 3: Normalize the data to 0-10 range if that's what you want
 print("\n=== Option 3: Normalized to 0-10 range ===")
 # Normalize to 0-10 range
-rem_normalized = ((rem - rem.min()) / (rem.max() - rem.min())) * 10
+rem_normalized = ((rem - rem_min) / (rem_max - rem_min)) * 10
 plt.figure(figsize=(12, 10))
 im3 = plt.imshow(rem_normalized.squeeze(), cmap=custom_cmap, 
                  vmin=0, vmax=10)
@@ -51,7 +56,7 @@ plt.show()
 print("\n=== Option 4: Using shade function with correct parameters ===")
 try:
     # With actual range
-    shade(rem.squeeze(), cmap=colors, span=[rem.min().values, rem.max().values], how='linear')
+    shade(rem.squeeze(), cmap=colors, span=[rem_min, rem_max], how='linear')
     
     # Or with normalized data
     # shade(rem_normalized.squeeze(), cmap=colors, span=[0, 10], how='linear')
@@ -64,13 +69,13 @@ fig, axes = plt.subplots(1, 3, figsize=(18, 6))
 
 # Full range
 im1 = axes[0].imshow(rem.squeeze(), cmap=custom_cmap, 
-                     vmin=rem.min().values, vmax=rem.max().values)
+                     vmin=rem_min, vmax=rem_max)
 axes[0].set_title('Full Range')
 axes[0].axis('off')
 plt.colorbar(im1, ax=axes[0], fraction=0.046, pad=0.04)
 
 # Upper range
-upper_percentile = np.percentile(rem.values, 85)
+upper_percentile = stats.percentile(85)
 im2 = axes[1].imshow(rem.squeeze(), cmap=custom_cmap, 
                      vmin=upper_percentile, vmax=0)
 axes[1].set_title('Upper 15% Range')
@@ -91,10 +96,27 @@ plt.show()
 # Show some statistics
 print(f"\nData Statistics:")
 print(f"Shape: {rem.shape}")
-print(f"Min: {rem.min().values:.2f}")
-print(f"Max: {rem.max().values:.2f}")
-print(f"Mean: {rem.mean().values:.2f}")
-print(f"Std: {rem.std().values:.2f}")
-print(f"25th percentile: {np.percentile(rem.values, 25):.2f}")
-print(f"75th percentile: {np.percentile(rem.values, 75):.2f}")
-print(f"90th percentile: {np.percentile(rem.values, 90):.2f}")
+print(f"Min: {rem_min:.2f}")
+print(f"Max: {rem_max:.2f}")
+print(f"Mean: {stats.mean:.2f}")
+print(f"Std: {stats.std:.2f}")
+print(f"25th percentile: {stats.percentile(25):.2f}")
+print(f"75th percentile: {stats.percentile(75):.2f}")
+print(f"90th percentile: {stats.percentile(90):.2f}")
+
+# Option 6: Headless renders straight to PNG (no figures - fast enough for batches of tiles)
+print("\n=== Option 6: Headless PNG renders ===")
+from render import render_rem_image
+
+render_rem_image("rem_full_range.png", rem, vmin=rem_min, vmax=rem_max)
+render_rem_image("rem_upper_range.png", rem, vmin=stats.percentile(85), vmax=0)
+render_rem_image("rem_normalized.png", rem_normalized, vmin=0, vmax=10)
+
+# Per-stage timings, enabled with REM_PROFILE=1 (or profiling.enable() before
+# the first cell) - open rem_trace.json in chrome://tracing or Perfetto
+import profiling
+
+if profiling.is_enabled():
+    profiling.report()
+    profiling.write_json("rem_profile.json")
+    profiling.write_chrome_trace("rem_trace.json")
@@ -0,0 +1,148 @@
+# Hillshade engine
+# The slope/aspect terms of the hillshade equation only depend on the DEM, so
+# they are computed once (one gradient pass, no trigonometry) and each
+# (azimuth, altitude) pair is then a couple of in-place float32 multiply-adds.
+
+import numpy as np
+
+from profiling import profiled
+
+METERS_PER_DEGREE = 111320.0
+
+
+def cell_size(raster):
+    """(dy, dx) cell size in metres from a raster's transform
+
+    Geographic (degree) grids are converted at the raster's centre latitude.
+    """
+    xres, yres = raster.rio.resolution()
+    dx, dy = abs(xres), abs(yres)
+
+    crs = raster.rio.crs
+    if crs is not None and crs.is_geographic:
+        center_lat = float(np.mean(raster.rio.bounds()[1::2]))
+        dy *= METERS_PER_DEGREE
+        dx *= METERS_PER_DEGREE * np.cos(np.radians(center_lat))
+
+    return dy, dx
+
+
+@profiled('shading_terms', cells=lambda terms: terms[0].size)
+def shading_terms(dem_data, spacing=(1.0, 1.0), z_factor=1.0):
+    """Per-cell terms of the hillshade equation, in float32
+
+    With slope = arctan(|grad|) and aspect = arctan2(-dx, dy):
+        cos_slope = cos(slope)
+        north     = sin(slope) * cos(aspect)
+        east      = sin(slope) * sin(aspect)
+    spacing is the (dy, dx) cell size, e.g. from cell_size().
+    """
+    dem_data = np.asarray(dem_data, dtype=np.float32)
+    if z_factor != 1:
+        dem_data = dem_data * np.float32(z_factor)
+
+    dy, dx = np.gradient(dem_data, *spacing)
+
+    # 1 / sqrt(1 + |grad|^2), built in place
+    cos_slope = np.multiply(dx, dx)
+    cos_slope += dy * dy
+    cos_slope += 1
+    np.sqrt(cos_slope, out=cos_slope)
+    np.reciprocal(cos_slope, out=cos_slope)
+
+    # sin(slope) * cos(aspect) = dy / sqrt(1 + |grad|^2), and likewise for -dx
+    north = np.multiply(dy, cos_slope, out=dy)
+    east = np.multiply(dx, cos_slope, out=dx)
+    np.negative(east, out=east)
+
+    return cos_slope, north, east
+
+
+def hillshade(terms, azimuth=315, altitude=45, out=None):
+    """Hillshade in [0, 1] for one light direction from precomputed terms"""
+    cos_slope, north, east = terms
+    azimuth_rad = np.radians(azimuth)
+    altitude_rad = np.radians(altitude)
+
+    # sin(alt) cos(slope) + cos(alt) sin(slope) cos(az - aspect)
+    out = np.multiply(north, np.float32(np.cos(altitude_rad) * np.cos(azimuth_rad)), out=out)
+    out += np.float32(np.cos(altitude_rad) * np.sin(azimuth_rad)) * east
+    out += np.float32(np.sin(altitude_rad)) * cos_slope
+
+    return np.clip(out, 0, 1, out=out)
+
+
+def hillshades(terms, angles):
+    """Hillshade for each (azimuth, altitude) pair, sharing one set of terms"""
+    return [hillshade(terms, azimuth, altitude) for azimuth, altitude in angles]
+
+
+def dem_hillshade(dem, azimuth=315, altitude=45, z_factor=1.0):
+    """Hillshade of a DataArray DEM using its real cell size"""
+    terms = shading_terms(dem.squeeze().values, spacing=cell_size(dem), z_factor=z_factor)
+    return hillshade(terms, azimuth, altitude)
+
+
+@profiled('multidirectional_hillshade', cells=lambda out: out.size)
+def multidirectional_hillshade(terms, azimuths=(225, 270, 315, 360), altitude=45, out=None):
+    """Blend hillshades from several azimuths, weighted by aspect
+
+    Each azimuth gets weight sin^2(aspect - azimuth), so every slope is
+    mostly lit across its face rather than straight on (as in GDAL's
+    -multidirectional). Computed in one pass over the cached terms.
+    """
+    cos_slope, north, east = terms
+    altitude_rad = np.radians(altitude)
+
+    shade = np.zeros_like(cos_slope) if out is None else out
+    shade[...] = 0
+    weight_sum = np.zeros_like(cos_slope)
+    weight = np.empty_like(cos_slope)
+    single = np.empty_like(cos_slope)
+
+    for azimuth in azimuths:
+        azimuth_rad = np.radians(azimuth)
+        sin_az = np.float32(np.sin(azimuth_rad))
+        cos_az = np.float32(np.cos(azimuth_rad))
+
+        # sin(slope) * sin(aspect - azimuth); the sin^2(slope) factor cancels
+        # when the weights are normalised
+        np.multiply(east, cos_az, out=weight)
+        weight -= north * sin_az
+        np.square(weight, out=weight)
+
+        hillshade((cos_slope, north, east), azimuth, altitude, out=single)
+        single *= weight
+        shade += single
+        weight_sum += weight
+
+    # Flat cells have no aspect - every azimuth lights them with sin(altitude)
+    flat = weight_sum == 0
+    np.divide(shade, weight_sum, out=shade, where=~flat)
+    shade[flat] = np.float32(max(np.sin(altitude_rad), 0))
+
+    return shade
+
+
+def multidirectional_hillshade_tiled(dem_data, spacing=(1.0, 1.0), azimuths=(225, 270, 315, 360),
+                                     altitude=45, tile_size=(1024, 1024), z_factor=1.0):
+    """multidirectional_hillshade computed tile by tile
+
+    Tiles are read with a one-cell halo, so gradients (and the result) match
+    the whole-raster computation while only one tile of terms is in memory.
+    """
+    from idw import iter_tiles
+
+    dem_data = np.asarray(dem_data)
+    out = np.empty(dem_data.shape, dtype=np.float32)
+    n_rows, n_cols = dem_data.shape
+
+    for rows, cols in iter_tiles(dem_data.shape, tile_size):
+        r0, r1 = max(rows.start - 1, 0), min(rows.stop + 1, n_rows)
+        c0, c1 = max(cols.start - 1, 0), min(cols.stop + 1, n_cols)
+
+        terms = shading_terms(dem_data[r0:r1, c0:c1], spacing=spacing, z_factor=z_factor)
+        shade = multidirectional_hillshade(terms, azimuths, altitude)
+        out[rows, cols] = shade[rows.start - r0:rows.stop - r0, cols.start - c0:cols.stop - c0]
+
+    return out
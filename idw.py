@@ -0,0 +1,371 @@
+# Tiled Inverse Distance Weight interpolation
+# Walks the target grid in row/column tiles so peak memory depends on the
+# tile size instead of the size of the DEM.
+
+import numpy as np
+
+from profiling import profiled
+
+try:
+    import numba
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+IDW_KERNELS = ('numpy', 'fused')
+
+
+def iter_tiles(shape, tile_size=(512, 512)):
+    """Yield (row_slice, col_slice) pairs covering a 2-D grid"""
+    n_rows, n_cols = shape
+    tile_rows, tile_cols = tile_size
+
+    for r0 in range(0, n_rows, tile_rows):
+        for c0 in range(0, n_cols, tile_cols):
+            yield (slice(r0, min(r0 + tile_rows, n_rows)),
+                   slice(c0, min(c0 + tile_cols, n_cols)))
+
+
+def idw_weights(distances, neighbour_values, power=1):
+    """Inverse distance weighted average of the queried neighbours"""
+    weights = 1 / (distances + 1e-10)  # Add small value to avoid division by zero
+    if power != 1:
+        weights **= power
+    weights = weights / weights.sum(axis=1).reshape(-1, 1)
+    return (weights * neighbour_values).sum(axis=1)
+
+
+def capped_idw_weights(distances, indices, values, power=1):
+    """IDW average that ignores neighbours missing from a capped query
+
+    A KDTree query with distance_upper_bound reports missing neighbours
+    with an infinite distance and an index equal to the number of samples.
+    Those get zero weight; cells with no neighbour at all become NaN.
+    """
+    found = np.isfinite(distances)
+    indices = np.where(found, indices, 0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weights = np.where(found, 1 / (distances + 1e-10), 0)
+        if power != 1:
+            weights **= power
+        weights = weights / weights.sum(axis=1).reshape(-1, 1)
+
+    return (weights * values[indices]).sum(axis=1)
+
+
+# -----------------------------------------------------------------------------
+# Fused weighting kernel
+# -----------------------------------------------------------------------------
+
+def _fused_idw_loop(distances, indices, values, power, out):
+    """One pass per cell: weighted sum and weight total, no (N, k) temporaries"""
+    n_cells, k = distances.shape
+    n_values = values.shape[0]
+    for i in _prange(n_cells):
+        weight_sum = 0.0
+        total = 0.0
+        hit = -1
+        for j in range(k):
+            d = distances[i, j]
+            index = indices[i, j]
+            if index >= n_values or not d < np.inf:
+                continue  # Missing neighbour of a capped query
+            if d == 0.0:
+                hit = index
+                break
+            w = 1.0 / d if power == 1.0 else d ** -power
+            weight_sum += w
+            total += w * values[index]
+        if hit >= 0:
+            out[i] = values[hit]
+        elif weight_sum > 0.0:
+            out[i] = total / weight_sum
+        else:
+            out[i] = np.nan
+
+
+# Two compiled variants: the parallel one is only for single whole-grid calls.
+# Per-tile calls come from pool workers, where nested Numba threads would
+# oversubscribe the cores (and abort under the workqueue threading layer), and
+# from thread pools, so the serial one releases the GIL. Numba's disk cache is
+# keyed by the Python function, not the parallel flag, so only the serial
+# variant is cached - otherwise a worker could load the parallel build.
+if HAS_NUMBA:
+    _prange = numba.prange
+    _fused_idw_kernel = numba.njit(nogil=True, cache=True)(_fused_idw_loop)
+    _fused_idw_kernel_parallel = numba.njit(parallel=True)(_fused_idw_loop)
+else:
+    _prange = range
+    _fused_idw_kernel = _fused_idw_kernel_parallel = None
+
+# Set once the parallel kernel has started Numba's thread pool; forking after
+# that can hang, so process pools then use the 'spawn' start method
+_numba_threads_started = False
+
+
+def _fused_idw_numpy(distances, indices, values, power, out, chunk_size=65536):
+    """NumPy fallback for the fused kernel, in cache-sized chunks of cells"""
+    for start in range(0, len(distances), chunk_size):
+        stop = min(start + chunk_size, len(distances))
+        d = distances[start:stop]
+        found = np.isfinite(d) & (indices[start:stop] < len(values))
+        v = values[np.where(found, indices[start:stop], 0)]
+
+        hit = found & (d == 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            w = np.where(found & ~hit, d, np.inf)
+            np.power(w, -power, out=w)  # Missing neighbours and hits get zero weight
+            result = np.einsum('ij,ij->i', w, v) / w.sum(axis=1)
+
+        hit_rows = hit.any(axis=1)
+        result[hit_rows] = v[hit_rows, hit[hit_rows].argmax(axis=1)]
+        out[start:stop] = result
+    return out
+
+
+def fused_idw(distances, indices, values, power=1, out=None, parallel=False):
+    """IDW average per cell in a single fused pass, as float32
+
+    distances, indices -- (N, k) KDTree query results; missing neighbours of
+                          a capped query (infinite distance) are ignored
+    power              -- IDW power: weights are 1 / distance**power
+    A neighbour at distance 0 is an exact hit and its value is used as is;
+    cells without any neighbour are NaN. Compiled with Numba when it is
+    installed, otherwise a chunked NumPy version is used. parallel=True
+    spreads the cells over Numba threads - use it only for a single
+    whole-grid call, never from thread or process pool workers.
+    """
+    global _numba_threads_started
+
+    distances = np.asarray(distances, dtype=np.float64).reshape(len(distances), -1)
+    indices = np.asarray(indices).reshape(len(distances), -1)
+    values = np.asarray(values, dtype=np.float64).ravel()
+    if out is None:
+        out = np.empty(len(distances), dtype=np.float32)
+
+    if _fused_idw_kernel is not None:
+        if parallel:
+            _numba_threads_started = True
+            _fused_idw_kernel_parallel(distances, indices, values, float(power), out)
+        else:
+            _fused_idw_kernel(distances, indices, values, float(power), out)
+        return out
+    return _fused_idw_numpy(distances, indices, values, power, out)
+
+
+def weigh_neighbours(distances, indices, values, power=1, kernel='numpy', capped=False,
+                     parallel=False):
+    """IDW average of the queried neighbours with the selected kernel
+
+    kernel='numpy' is the original expression chain (the default, kept for
+    bit-identical results); 'fused' uses fused_idw (parallel is passed on).
+    """
+    if kernel == 'fused':
+        return fused_idw(distances, indices, values, power, parallel=parallel)
+    if kernel != 'numpy':
+        raise ValueError(f"Unknown IDW kernel: {kernel!r} (use one of {', '.join(IDW_KERNELS)})")
+    if capped:
+        return capped_idw_weights(distances, indices, values, power)
+    return idw_weights(distances, values[indices], power)
+
+
+def tile_is_far(tree, c_x, c_y, max_distance):
+    """True if no sample can be within max_distance of any cell in the tile"""
+    center = [[(c_x[0] + c_x[-1]) / 2, (c_y[0] + c_y[-1]) / 2]]
+    half_diagonal = np.hypot(c_x[-1] - c_x[0], c_y[-1] - c_y[0]) / 2
+
+    distance, _ = tree.query(center, k=1)
+    return np.min(distance) > max_distance + half_diagonal
+
+
+def idw_tile(tree, values, c_x, c_y, k=5, workers=None, max_distance=None, mask=None,
+             power=1, kernel='numpy'):
+    """Interpolate one tile given its x and y coordinate vectors
+
+    workers      -- forwarded to tree.query (SciPy's cKDTree supports it,
+                    the scikit-learn KDTree does not)
+    max_distance -- search radius; cells with no sample inside it are NaN
+                    (SciPy cKDTree only, via distance_upper_bound)
+    mask         -- boolean (len(c_y), len(c_x)) array; cells outside it are
+                    not queried and left as NaN
+    power        -- IDW power (weights are 1 / distance**power)
+    kernel       -- 'numpy' or 'fused' weighting, see weigh_neighbours
+    """
+    # (x, y) coordinates of every cell in the tile
+    c_interpolate = np.dstack(np.meshgrid(c_x, c_y)).reshape(-1, 2)
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool).ravel()
+        c_interpolate = c_interpolate[mask]
+
+    query_kwargs = {}
+    if workers is not None:
+        query_kwargs['workers'] = workers
+    if max_distance is not None:
+        query_kwargs['distance_upper_bound'] = max_distance
+
+    distances, indices = tree.query(c_interpolate, k=k, **query_kwargs)
+    distances = distances.reshape(len(c_interpolate), -1)
+    indices = indices.reshape(len(c_interpolate), -1)
+
+    interpolated = weigh_neighbours(distances, indices, values, power=power, kernel=kernel,
+                                    capped=max_distance is not None)
+
+    if mask is not None:
+        result = np.full(mask.size, np.nan)
+        result[mask] = interpolated
+        interpolated = result
+
+    return interpolated.reshape((len(c_y), len(c_x)))
+
+
+def fill_tile(out, tree, values, c_x, c_y, rows, cols, k=5, workers=None,
+              max_distance=None, mask=None, power=1, kernel='numpy'):
+    """Interpolate the tile (rows, cols) of the grid into out"""
+    tile_mask = None if mask is None else mask[rows, cols]
+
+    if tile_mask is not None and not tile_mask.any():
+        out[rows, cols] = np.nan
+    elif max_distance is not None and tile_is_far(tree, c_x[cols], c_y[rows], max_distance):
+        # Whole tile is far-field - skip the neighbour query entirely
+        out[rows, cols] = np.nan
+    else:
+        out[rows, cols] = idw_tile(tree, values, c_x[cols], c_y[rows], k=k, workers=workers,
+                                   max_distance=max_distance, mask=tile_mask, power=power,
+                                   kernel=kernel)
+
+
+@profiled('idw', cells=lambda out: out.size)
+def idw_interpolate(tree, values, c_x, c_y, k=5, tile_size=(512, 512), out=None,
+                    workers=None, max_distance=None, mask=None, power=1, kernel='numpy'):
+    """Interpolate sample values onto the grid defined by c_x and c_y
+
+    tree         -- KDTree built from the sampled (x, y) coordinates
+    values       -- sampled values, in the same order as the tree's points
+    c_x, c_y     -- coordinate vectors of the target grid
+    tile_size    -- (rows, cols) processed per KDTree query
+    out          -- optional preallocated (len(c_y), len(c_x)) array to fill
+    workers      -- threads used by each KDTree query (SciPy cKDTree only)
+    max_distance -- search radius in grid units; cells further than this from
+                    every sample are left as NaN (SciPy cKDTree only)
+    mask         -- optional boolean (len(c_y), len(c_x)) valley-corridor
+                    mask; cells outside it are skipped and left as NaN
+    power        -- IDW power (weights are 1 / distance**power)
+    kernel       -- 'numpy' (default) or 'fused' single-pass weighting
+    """
+    c_x = np.asarray(c_x)
+    c_y = np.asarray(c_y)
+    values = np.asarray(values).ravel()
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+
+    if out is None:
+        out = np.empty((len(c_y), len(c_x)), dtype=np.float32)
+
+    for rows, cols in iter_tiles(out.shape, tile_size):
+        fill_tile(out, tree, values, c_x, c_y, rows, cols, k=k, workers=workers,
+                  max_distance=max_distance, mask=mask, power=power, kernel=kernel)
+
+    return out
+
+
+# -----------------------------------------------------------------------------
+# Parallel interpolation
+# -----------------------------------------------------------------------------
+
+# State handed to each worker process by _init_worker
+_worker_state = {}
+
+
+def _init_worker(tree, values, c_x, c_y, options, shm_name, shape):
+    """Attach a worker process to the shared output raster"""
+    from multiprocessing import shared_memory
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _worker_state.update(
+        tree=tree, values=values, c_x=c_x, c_y=c_y, options=options, shm=shm,
+        out=np.ndarray(shape, dtype=np.float32, buffer=shm.buf),
+    )
+
+
+def _process_tile(rows, cols):
+    """Interpolate one tile inside a worker process"""
+    s = _worker_state
+    fill_tile(s['out'], s['tree'], s['values'], s['c_x'], s['c_y'], rows, cols, **s['options'])
+
+
+@profiled('idw_parallel', cells=lambda out: out.size)
+def idw_interpolate_parallel(tree, values, c_x, c_y, k=5, tile_size=(512, 512),
+                             n_workers=None, executor='thread', out=None,
+                             max_distance=None, mask=None, power=1, kernel='numpy'):
+    """Parallel version of idw_interpolate
+
+    Tiles are spread over a pool of n_workers (defaults to the CPU count) and
+    written straight into one output raster. With executor='thread' the
+    workers share `out` directly (KDTree queries and the NumPy weighting
+    release the GIL); with executor='process' the raster lives in shared
+    memory; executor='kdtree' keeps the tile loop serial and lets SciPy's
+    cKDTree parallelise each query with its own `workers` threads. Each cell
+    is computed exactly as in the serial path, so the result is bit-identical
+    to idw_interpolate.
+    """
+    import os
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+
+    c_x = np.asarray(c_x)
+    c_y = np.asarray(c_y)
+    values = np.asarray(values).ravel()
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+    n_workers = n_workers or os.cpu_count() or 1
+    options = dict(k=k, max_distance=max_distance, mask=mask, power=power, kernel=kernel)
+
+    if out is None:
+        out = np.empty((len(c_y), len(c_x)), dtype=np.float32)
+
+    if n_workers == 1:
+        return idw_interpolate(tree, values, c_x, c_y, tile_size=tile_size, out=out, **options)
+
+    if executor == 'kdtree':
+        return idw_interpolate(tree, values, c_x, c_y, tile_size=tile_size, out=out,
+                               workers=n_workers, **options)
+
+    tiles = list(iter_tiles(out.shape, tile_size))
+
+    if executor == 'thread':
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            futures = [pool.submit(fill_tile, out, tree, values, c_x, c_y, rows, cols, **options)
+                       for rows, cols in tiles]
+            for future in futures:
+                future.result()  # Re-raise worker errors
+        return out
+
+    if executor != 'process':
+        raise ValueError(f"Unknown executor: {executor!r} (use 'thread', 'process' or 'kdtree')")
+
+    import multiprocessing
+    from multiprocessing import shared_memory
+
+    # Forking once Numba's thread pool runs can hang the children at exit
+    mp_context = multiprocessing.get_context('spawn') if _numba_threads_started else None
+
+    shm = shared_memory.SharedMemory(create=True, size=out.size * np.dtype(np.float32).itemsize)
+    try:
+        shared_out = np.ndarray(out.shape, dtype=np.float32, buffer=shm.buf)
+        with ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=mp_context,
+            initializer=_init_worker,
+            initargs=(tree, values, c_x, c_y, options, shm.name, out.shape),
+        ) as pool:
+            futures = [pool.submit(_process_tile, rows, cols) for rows, cols in tiles]
+            wait(futures)
+            for future in futures:
+                future.result()
+        out[...] = shared_out
+        del shared_out
+    finally:
+        shm.close()
+        shm.unlink()
+
+    return out
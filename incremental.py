@@ -0,0 +1,207 @@
+# Incremental REM recompute
+# When the river geometry or the sample threshold changes, only grid blocks
+# whose k nearest samples can have changed are re-interpolated. A changed
+# sample can only matter to a cell if it is closer than the cell's k-th
+# neighbour (before or after the edit), so each block is tested against a
+# radius derived from the k-th neighbour distance at its centre. The water
+# surface and REM are kept as memory-mapped .npy files and patched in place.
+
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+from scipy.spatial import cKDTree as KDTree
+
+from idw import iter_tiles, fill_tile
+from knn_cache import array_digest
+
+
+def _rows(points, values):
+    """One void scalar per (x, y, value) row, for set operations"""
+    rows = np.ascontiguousarray(np.column_stack([points, values]), dtype=np.float64)
+    return rows.view(np.dtype((np.void, rows.dtype.itemsize * rows.shape[1]))).ravel()
+
+
+def changed_samples(old_points, old_values, new_points, new_values):
+    """(n, 2) coordinates of samples added, removed or with a new value"""
+    old_points = np.asarray(old_points, dtype=np.float64).reshape(-1, 2)
+    new_points = np.asarray(new_points, dtype=np.float64).reshape(-1, 2)
+    old_rows = _rows(old_points, np.ravel(old_values))
+    new_rows = _rows(new_points, np.ravel(new_values))
+
+    removed = old_points[~np.isin(old_rows, new_rows)]
+    added = new_points[~np.isin(new_rows, old_rows)]
+    return np.concatenate([removed, added])
+
+
+def _influence_radius(tree, centres, k, max_distance, half_diagonal):
+    """Distance from each block centre beyond which a sample can't be a cell's neighbour"""
+    if tree is None or tree.n == 0:
+        return np.full(len(centres), np.inf)
+    distances, _ = tree.query(centres, k=k)
+    kth = np.reshape(distances, (len(centres), -1))[:, -1] + half_diagonal
+    if max_distance is not None:
+        kth = np.minimum(kth, max_distance)
+    return kth + half_diagonal
+
+
+def affected_tiles(old_tree, new_tree, changed, c_x, c_y, k=5, tile_size=(512, 512),
+                   max_distance=None):
+    """(rows, cols) tiles of the grid whose IDW result may differ after the edit"""
+    if len(changed) == 0:
+        return []
+
+    tiles = list(iter_tiles((len(c_y), len(c_x)), tile_size))
+    centres = np.array([[(c_x[cols.start] + c_x[cols.stop - 1]) / 2,
+                         (c_y[rows.start] + c_y[rows.stop - 1]) / 2] for rows, cols in tiles])
+    half_diagonal = np.array([np.hypot(c_x[cols.stop - 1] - c_x[cols.start],
+                                       c_y[rows.stop - 1] - c_y[rows.start]) / 2
+                              for rows, cols in tiles])
+
+    radius = np.maximum(
+        _influence_radius(old_tree, centres, k, max_distance, half_diagonal),
+        _influence_radius(new_tree, centres, k, max_distance, half_diagonal),
+    )
+
+    nearest_change, _ = KDTree(changed).query(centres, k=1)
+    return [tile for tile, hit in zip(tiles, nearest_change <= radius) if hit]
+
+
+def update_surface(surface, new_tree, new_values, c_x, c_y, tiles, k=5, max_distance=None,
+                   mask=None, power=1, kernel='numpy'):
+    """Re-interpolate the given tiles of surface in place with the new samples"""
+    c_x, c_y = np.asarray(c_x), np.asarray(c_y)
+    values = np.asarray(new_values).ravel()
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+    for rows, cols in tiles:
+        fill_tile(surface, new_tree, values, c_x, c_y, rows, cols, k=k,
+                  max_distance=max_distance, mask=mask, power=power, kernel=kernel)
+    return surface
+
+
+def update_rem(rem, dem, surface, tiles):
+    """Recompute rem = dem - surface on the given tiles only"""
+    dem = dem.squeeze()
+    for rows, cols in tiles:
+        rem[rows, cols] = (np.asarray(dem[rows, cols].values, dtype=np.float32) -
+                           np.asarray(surface[rows, cols], dtype=np.float32))
+    return rem
+
+
+def patch_raster(path, source, tiles):
+    """Write the given tiles of source into an existing GeoTIFF, then refresh its overviews
+
+    Scaled int16 files are re-encoded with the file's own scale and
+    offset. A COG stays a valid GeoTIFF but loses its strict COG layout;
+    rewrite it with cog.write_cog when that matters.
+    """
+    import rasterio
+    from rasterio.enums import Resampling
+    from rasterio.windows import Window
+
+    from cog import encode_block
+
+    with rasterio.open(path, 'r+') as dst:
+        encoding = 'int16' if dst.dtypes[0] == 'int16' else 'float32'
+        scale, offset = dst.scales[0], dst.offsets[0]
+        for rows, cols in tiles:
+            block = encode_block(source[rows, cols], encoding, scale, offset)
+            window = Window(cols.start, rows.start, cols.stop - cols.start, rows.stop - rows.start)
+            dst.write(block, 1, window=window)
+
+        factors = dst.overviews(1)
+        if factors and tiles:
+            dst.build_overviews(factors, Resampling.average)
+    return path
+
+
+# -----------------------------------------------------------------------------
+# Stored state
+# -----------------------------------------------------------------------------
+
+def state_params(c_x, c_y, k=5, max_distance=None, mask=None, power=1, kernel='numpy'):
+    """Everything besides the samples that a stored REM state depends on"""
+    mask = None if mask is None else np.asarray(mask, dtype=bool)
+    return {'grid': array_digest(np.asarray(c_x), np.asarray(c_y)), 'k': k,
+            'max_distance': max_distance, 'mask': array_digest(mask), 'power': power,
+            'kernel': kernel}
+
+
+def state_matches(state_dir, c_x, c_y, k=5, max_distance=None, mask=None, power=1,
+                  kernel='numpy'):
+    """True if state_dir holds a REM state built with these grid, mask and IDW parameters"""
+    path = Path(state_dir) / 'state.json'
+    if not path.exists():
+        return False
+    meta = json.loads(path.read_text())
+    return meta == json.loads(json.dumps(state_params(c_x, c_y, k, max_distance, mask,
+                                                      power, kernel)))
+
+
+def save_state(state_dir, points, values, c_x, c_y, surface, rem, k=5, max_distance=None,
+               mask=None, power=1, kernel='numpy'):
+    """Store samples, grid and rasters of a full REM build for later incremental updates"""
+    state_dir = Path(state_dir)
+    state_dir.mkdir(parents=True, exist_ok=True)
+    np.save(state_dir / 'points.npy', np.asarray(points, dtype=np.float64))
+    np.save(state_dir / 'values.npy', np.asarray(values, dtype=np.float64).ravel())
+    np.save(state_dir / 'surface.npy', np.asarray(surface, dtype=np.float32))
+    np.save(state_dir / 'rem.npy', np.asarray(getattr(rem, 'values', rem), dtype=np.float32))
+    meta = state_params(c_x, c_y, k, max_distance, mask, power, kernel)
+    (state_dir / 'state.json').write_text(json.dumps(meta))
+
+
+def load_state(state_dir):
+    """(meta, points, values, surface, rem) - the rasters memory-mapped for in-place updates"""
+    state_dir = Path(state_dir)
+    meta = json.loads((state_dir / 'state.json').read_text())
+    return (meta, np.load(state_dir / 'points.npy'), np.load(state_dir / 'values.npy'),
+            np.load(state_dir / 'surface.npy', mmap_mode='r+'),
+            np.load(state_dir / 'rem.npy', mmap_mode='r+'))
+
+
+def incremental_rem(state_dir, dem, new_points, new_values, c_x, c_y, k=5, tile_size=(512, 512),
+                    max_distance=None, mask=None, rem_path=None, power=1, kernel='numpy',
+                    elevation_path=None):
+    """Update a stored REM for a new sample set, returning the recomputed tiles
+
+    Only tiles whose k nearest samples may have changed are re-interpolated
+    and re-subtracted; rem_path and elevation_path, if given, are earlier
+    GeoTIFFs of the same REM and water surface that are patched in place.
+    Raises ValueError if the stored state was built on another grid, mask
+    or IDW parameters (check with state_matches and run a full build).
+    """
+    if not state_matches(state_dir, c_x, c_y, k, max_distance, mask, power, kernel):
+        raise ValueError("Stored REM state does not match this grid, mask or IDW parameters - "
+                         "run a full build and save_state first")
+    _, old_points, old_values, surface, rem = load_state(state_dir)
+
+    new_points = np.asarray(new_points, dtype=np.float64)
+    new_values = np.asarray(new_values, dtype=np.float64).ravel()
+    changed = changed_samples(old_points, old_values, new_points, new_values)
+
+    old_tree = KDTree(old_points) if len(old_points) else None
+    new_tree = KDTree(new_points)
+    tiles = affected_tiles(old_tree, new_tree, changed, c_x, c_y, k=k, tile_size=tile_size,
+                           max_distance=max_distance)
+
+    update_surface(surface, new_tree, new_values, c_x, c_y, tiles, k=k,
+                   max_distance=max_distance, mask=mask, power=power, kernel=kernel)
+    update_rem(rem, dem, surface, tiles)
+    surface.flush()
+    rem.flush()
+
+    # Samples are replaced last, so an interrupted update is redone next time
+    state_dir = Path(state_dir)
+    for name, array in (('points', new_points), ('values', new_values)):
+        tmp_path = state_dir / f"{name}.tmp.npy"
+        np.save(tmp_path, array)
+        os.replace(tmp_path, state_dir / f"{name}.npy")
+
+    if rem_path is not None:
+        patch_raster(rem_path, rem, tiles)
+    if elevation_path is not None:
+        patch_raster(elevation_path, surface, tiles)
+    return tiles
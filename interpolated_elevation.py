@@ -1,9 +1,35 @@
 # Calculate REM by subtracting interpolated elevation from original DEM
-rem = dem_clipped.squeeze() - elevation_raster
+# (cells outside the river corridor, if any, are NaN in elevation_raster and
+# stay NaN here, so plots and renders leave them transparent)
+if incremental_update:
+    # Only the changed blocks were recomputed, in the stored REM
+    rem = xr.DataArray(rem_values, dims=('y', 'x'), coords=elevation_raster.coords)
+else:
+    from profiling import stage
+
+    with stage('rem_subtraction', cells=elevation_raster.size):
+        rem = dem_clipped.squeeze() - elevation_raster
+    if rem_state_dir is not None and surface_method == 'idw':
+        from incremental import save_state
+        save_state(rem_state_dir, c_sampled, values, c_x, c_y, interpolated_values, rem,
+                   k=5, max_distance=max_distance, mask=valley_mask, power=idw_power,
+                   kernel=idw_kernel)
 
 print(f"REM shape: {rem.shape}")
 print(f"REM value range: {rem.min().values:.2f} to {rem.max().values:.2f}")
 
+# Save the REM (and the interpolated water surface) as tiled, compressed COGs
+# with overviews - each block is computed and written on its own. An
+# incremental update has already patched its changed blocks into both files.
+from cog import write_cog, difference_source
+
+if not outputs_patched:
+    rem_source = rem_values if incremental_update else difference_source(dem_clipped, elevation_raster.values)
+    write_cog(rem_outputs[0], rem_source,
+              transform=dem_clipped.rio.transform(), crs=dem_clipped.rio.crs)
+    write_cog(rem_outputs[1], elevation_raster.values,
+              transform=dem_clipped.rio.transform(), crs=dem_clipped.rio.crs)
+
 # Basic REM visualization
 fig, (ax1, ax2, ax3) = plt.subplots(1, 3, figsize=(18, 6))
 
@@ -0,0 +1,245 @@
+# Persistent cache for the river-sample KDTree and its neighbour queries
+# The tree and the (distances, indices) of the k nearest samples of every grid
+# cell only depend on the sample coordinates and the grid, so they are stored
+# on disk under a hash of those inputs. The grid is queried once, uncapped,
+# at the largest k asked for, so parameter sweeps (k up to that, any search
+# radius, IDW power) and re-renders only redo the cheap weighting step. Least
+# recently used entries are evicted past CACHE_MAX_BYTES or CACHE_TTL.
+
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from idw import iter_tiles, weigh_neighbours
+from profiling import profiled
+
+CACHE_DIR = Path(os.environ.get('REM_KNN_CACHE', Path.home() / '.cache' / 'rem' / 'knn'))
+CACHE_TTL = 30 * 24 * 3600              # seconds since last use
+CACHE_MAX_BYTES = 8 * 1024 ** 3         # total size before the oldest entries are evicted
+
+
+def array_digest(*arrays, **params):
+    """sha256 of the arrays' dtype, shape and bytes plus any JSON-able params"""
+    h = hashlib.sha256()
+    for array in arrays:
+        if array is None:
+            h.update(b'none')
+            continue
+        array = np.ascontiguousarray(array)
+        h.update(f"{array.dtype.str}{array.shape}".encode('utf-8'))
+        h.update(array.tobytes())
+    h.update(json.dumps(params, sort_keys=True, default=str).encode('utf-8'))
+    return h.hexdigest()
+
+
+def _temp_path(path):
+    """Unique temp file next to path, so concurrent writers of one entry never collide"""
+    with tempfile.NamedTemporaryFile(dir=path.parent, prefix=path.name + '.', suffix='.tmp',
+                                     delete=False) as tmp:
+        return Path(tmp.name)
+
+
+def cached_tree(points, cache_dir=CACHE_DIR):
+    """SciPy cKDTree for points, unpickled from the cache when it was built before"""
+    from scipy.spatial import cKDTree
+
+    points = np.asarray(points, dtype=np.float64)
+    cache_dir = Path(cache_dir)
+    path = cache_dir / f"tree-{array_digest(points)}.pkl"
+
+    if path.exists():
+        os.utime(path)  # Mark as recently used
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+    tree = cKDTree(points)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    tmp_path = _temp_path(path)
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(tree, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+    evict(cache_dir, keep=_entry(path))
+    return tree
+
+
+def neighbours_key(points, c_x, c_y, mask=None):
+    """Cache key for the nearest-neighbour query of a grid (independent of k and radius)"""
+    return array_digest(points, c_x, c_y, mask)
+
+
+def _entry(path):
+    """Cache entry a file belongs to: 'tree-<digest>' or 'knn-<digest>'"""
+    return '-'.join(path.name.split('.')[0].split('-')[:2])
+
+
+def evict(cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES, ttl=CACHE_TTL, keep=None):
+    """Remove entries unused for ttl seconds, then the least recently used past max_bytes
+
+    keep -- entry name ('knn-<digest>') that is never evicted, e.g. the one just written
+    """
+    cache_dir = Path(cache_dir)
+    entries = {}
+    for path in list(cache_dir.glob('tree-*.pkl')) + list(cache_dir.glob('knn-*.npy')):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        entry = entries.setdefault(_entry(path), {'files': [], 'size': 0, 'used': 0.0})
+        entry['files'].append(path)
+        entry['size'] += stat.st_size
+        entry['used'] = max(entry['used'], stat.st_mtime)
+
+    now = time.time()
+    total = sum(entry['size'] for entry in entries.values())
+    for name in sorted(entries, key=lambda n: entries[n]['used']):
+        entry = entries[name]
+        if name == keep:
+            continue
+        if total <= max_bytes and (ttl is None or now - entry['used'] <= ttl):
+            continue
+        for path in entry['files']:
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+        total -= entry['size']
+
+
+def query_grid(tree, c_x, c_y, distances, indices, k, tile_size=(512, 512), workers=None,
+               max_distance=None, mask=None):
+    """Fill (n_cells, k) distances/indices with the tree query of every grid cell
+
+    Cells are in row-major (y, x) order. Cells outside mask are not queried
+    and are stored as not found (infinite distance, index = number of
+    samples), like cells beyond max_distance.
+    """
+    query_kwargs = {}
+    if workers is not None:
+        query_kwargs['workers'] = workers
+    if max_distance is not None:
+        query_kwargs['distance_upper_bound'] = max_distance
+
+    n_cols = len(c_x)
+    for rows, cols in iter_tiles((len(c_y), len(c_x)), tile_size):
+        xx, yy = np.meshgrid(c_x[cols], c_y[rows])
+        cells = (np.arange(rows.start, rows.stop)[:, None] * n_cols
+                 + np.arange(cols.start, cols.stop)).ravel()
+        points = np.column_stack([xx.ravel(), yy.ravel()])
+
+        if mask is not None:
+            tile_mask = mask[rows, cols].ravel()
+            distances[cells[~tile_mask]] = np.inf
+            indices[cells[~tile_mask]] = tree.n
+            cells, points = cells[tile_mask], points[tile_mask]
+            if len(cells) == 0:
+                continue
+
+        d, i = tree.query(points, k=k, **query_kwargs)
+        distances[cells] = d.reshape(len(cells), -1)
+        indices[cells] = i.reshape(len(cells), -1)
+
+
+def _cached_k(path):
+    """Number of neighbours stored in a cached .npy query result (0 if missing)"""
+    try:
+        return np.load(path, mmap_mode='r').shape[1]
+    except (FileNotFoundError, ValueError):
+        return 0
+
+
+@profiled('knn_query', cells=lambda result: result[0].shape[0])
+def cached_neighbours(tree, c_x, c_y, k=5, tile_size=(512, 512), workers=None, mask=None,
+                      cache_dir=CACHE_DIR):
+    """(distances, indices) of at least the k nearest samples of every grid cell
+
+    The query is uncapped, so any search radius can be applied afterwards
+    by idw_from_neighbours. A cached result with k or more neighbours is
+    reused; otherwise the grid is queried again at k and the entry
+    replaced. Results are stored as .npy files and returned memory-mapped
+    read-only, so large grids are never fully loaded. Shapes are
+    (len(c_y) * len(c_x), k_cached) with k_cached >= k.
+    """
+    c_x, c_y = np.asarray(c_x), np.asarray(c_y)
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+    cache_dir = Path(cache_dir)
+    digest = neighbours_key(tree.data, c_x, c_y, mask)
+    dist_path = cache_dir / f"knn-{digest}-distances.npy"
+    index_path = cache_dir / f"knn-{digest}-indices.npy"
+
+    if min(_cached_k(dist_path), _cached_k(index_path)) < k:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        shape = (len(c_y) * len(c_x), k)
+        tmp_dist = _temp_path(dist_path)
+        tmp_index = _temp_path(index_path)
+        distances = np.lib.format.open_memmap(tmp_dist, mode='w+', dtype=np.float64, shape=shape)
+        indices = np.lib.format.open_memmap(tmp_index, mode='w+', dtype=np.intp, shape=shape)
+        query_grid(tree, c_x, c_y, distances, indices, k, tile_size=tile_size, workers=workers,
+                   mask=mask)
+        distances.flush()
+        indices.flush()
+        del distances, indices
+        os.replace(tmp_dist, dist_path)
+        os.replace(tmp_index, index_path)
+        evict(cache_dir, keep=f"knn-{digest}")
+    else:
+        os.utime(dist_path)
+        os.utime(index_path)
+
+    return np.load(dist_path, mmap_mode='r'), np.load(index_path, mmap_mode='r')
+
+
+@profiled('idw_weighting', cells=lambda out: out.size)
+def idw_from_neighbours(distances, indices, values, shape, k=None, max_distance=None,
+                        mask=None, chunk_rows=512, out=None, power=1, kernel='numpy'):
+    """IDW raster from precomputed neighbour queries (the weighting step only)
+
+    Neighbours are expected from an uncapped query (cached_neighbours): only
+    the first k are used and any at max_distance or further are dropped, as
+    a capped KDTree query would. power and kernel are as in idw.idw_interpolate;
+    with the same k, max_distance, mask, power and kernel the result is
+    identical to it.
+    """
+    values = np.asarray(values).ravel()
+    n_rows, n_cols = shape
+    k = k or distances.shape[1]
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool)
+    if out is None:
+        out = np.empty(shape, dtype=np.float32)
+
+    for r0 in range(0, n_rows, chunk_rows):
+        r1 = min(r0 + chunk_rows, n_rows)
+        d = np.asarray(distances[r0 * n_cols:r1 * n_cols, :k])
+        i = np.asarray(indices[r0 * n_cols:r1 * n_cols, :k])
+
+        found = np.isfinite(d)
+        if max_distance is not None:
+            found &= d < max_distance
+
+        if found.all():
+            chunk = weigh_neighbours(d, i, values, power=power, kernel=kernel, parallel=True)
+        else:
+            chunk = weigh_neighbours(np.where(found, d, np.inf), i, values, power=power,
+                                     kernel=kernel, capped=True, parallel=True)
+
+        if mask is not None:
+            chunk[~mask[r0:r1].ravel()] = np.nan
+        out[r0:r1] = chunk.reshape(r1 - r0, n_cols)
+
+    return out
+
+
+def clear_cache(cache_dir=CACHE_DIR):
+    """Remove every cached tree and neighbour query"""
+    cache_dir = Path(cache_dir)
+    if not cache_dir.exists():
+        return
+    for path in list(cache_dir.glob('tree-*')) + list(cache_dir.glob('knn-*')):
+        path.unlink()
@@ -20,6 +20,8 @@ from rasterio.plot import show
 from rasterio.features import shapes
 from rasterio.transform import from_bounds
 import warnings
+from osm_cache import bbox_key, cached
+from overpass import find_rivers, fetch_way_geometries
 warnings.filterwarnings('ignore')
 
 print("All packages installed successfully!")
@@ -88,8 +90,15 @@ def visualize_tif(tif_path):
         print(f"Error visualizing TIF: {e}")
 
 # Function to query OSM for rivers using multiple methods
-def find_rivers_in_bounds(bounds, buffer_km=1):
-    """Find rivers within the given bounds using OSM - multiple methods"""
+def find_rivers_in_bounds(bounds, buffer_km=1, use_cache=True, concurrent=True):
+    """Find rivers within the given bounds using OSM - multiple methods
+    
+    Results are cached on disk by bbox, so repeat runs skip the network.
+    With concurrent=True the lookups run on a pooled async client (see
+    overpass.py), still trying the methods in order as fallbacks, and way
+    geometries come back in batched requests; otherwise the original
+    synchronous methods are tried one after another.
+    """
     minx, miny, maxx, maxy = bounds
     
     # Add buffer to search area (convert km to degrees approximately)
@@ -99,8 +108,21 @@ def find_rivers_in_bounds(bounds, buffer_km=1):
     bbox = (miny - buffer_deg, minx - buffer_deg, 
             maxy + buffer_deg, maxx + buffer_deg)
     
+    if use_cache:
+        key = bbox_key(bbox, {'waterway': ['river', 'stream', 'creek', 'brook', 'canal']})
+        return cached(key, lambda: find_rivers_in_bounds(bounds, buffer_km, use_cache=False,
+                                                         concurrent=concurrent))
+    
     print(f"Searching for rivers in bbox: {bbox}")
     
+    if concurrent:
+        try:
+            rivers_data = find_rivers(bbox)
+            print(f"Total found: {len(rivers_data)} rivers/waterways in the area")
+            return rivers_data
+        except Exception as e:
+            print(f"Concurrent lookup failed, falling back to sequential methods: {e}")
+    
     rivers_data = []
     
     # Method 1: Try with Overpass API (simplified query)
@@ -236,11 +258,15 @@ def find_rivers_in_bounds(bounds, buffer_km=1):
             print(f"Direct HTTP method failed: {e}")
     
     print(f"Total found: {len(rivers_data)} rivers/waterways in the area")
-    return rivers_data, formatted_ids
+    return rivers_data
 
 # Function to create interactive map
-def create_interactive_map(bounds, rivers_data):
-    """Create an interactive map showing the TIF bounds and found rivers"""
+def create_interactive_map(bounds, rivers_data, rem_tiles=None, rem_max_zoom=None):
+    """Create an interactive map showing the TIF bounds and found rivers
+    
+    rem_tiles is an optional z/x/y tile directory from tiles.build_tile_pyramid,
+    added as an overlay layer.
+    """
     try:
         minx, miny, maxx, maxy = bounds
         center_lat = (miny + maxy) / 2
@@ -272,6 +298,12 @@ def create_interactive_map(bounds, rivers_data):
                     popup=f"OSM ID: {river['osm_id']}<br>Name: {river['name']}<br>Type: {river['waterway_type']}"
                 ).add_to(m)
         
+        # Add REM tile pyramid
+        if rem_tiles:
+            from tiles import add_tile_layer
+            add_tile_layer(m, rem_tiles, max_zoom=rem_max_zoom)
+            folium.LayerControl().add_to(m)
+        
         return m
         
     except Exception as e:
@@ -307,6 +339,24 @@ def get_waterway_coordinates(osm_id, osm_type='way'):
     except Exception as e:
         print(f"Error getting coordinates for {osm_type} {osm_id}: {e}")
         return []
+
+# Function to get coordinates for many waterways at once
+def add_waterway_coordinates(rivers_data, batch_size=200):
+    """Fill in missing way coordinates with batched Overpass requests"""
+    missing = [river['osm_id'] for river in rivers_data
+               if river['osm_type'] == 'way' and not river['coordinates']]
+    if not missing:
+        return rivers_data
+    
+    try:
+        geometries = fetch_way_geometries(missing, batch_size=batch_size)
+        for river in rivers_data:
+            if river['osm_type'] == 'way' and not river['coordinates']:
+                river['coordinates'] = geometries.get(river['osm_id'], [])
+    except Exception as e:
+        print(f"Error getting waterway coordinates: {e}")
+    
+    return rivers_data
 def find_closest_river(bounds, rivers_data):
     """Find the river closest to the center of the TIF bounds"""
     try:
@@ -333,7 +383,13 @@ def find_closest_river(bounds, rivers_data):
         return None, None
 
 # Main execution
-def main(tif_path="/content/USGS_1_n52w119_20130911.tif"):
+def main(tif_path="/content/USGS_1_n52w119_20130911.tif", rem_tiles=None, rem_max_zoom=None,
+         map_path="river_map.html"):
+    """Find the rivers around a DEM, map them and return their formatted OSM IDs
+
+    rem_tiles -- optional REM tile directory (tiles.build_tile_pyramid) shown on the map
+    map_path -- HTML file the interactive map is saved to (None to skip saving)
+    """
     print("=== River OSM ID Finder ===\n")
     
     # Step 1: Check if TIF file exists
@@ -365,6 +421,9 @@ def main(tif_path="/content/USGS_1_n52w119_20130911.tif"):
         print("No rivers found in the specified area.")
         return
     
+    # Geometry for all ways in one or two round-trips
+    rivers_data = add_waterway_coordinates(rivers_data)
+    
     # Step 5: Display results in the required format
     print("\n--- Found Rivers (OSM ID Format) ---")
     for i, river in enumerate(rivers_data, 1):
@@ -406,16 +465,15 @@ def main(tif_path="/content/USGS_1_n52w119_20130911.tif"):
     if len(formatted_ids) > 10:
         print(f"... and {len(formatted_ids) - 10} more")
     
-    return formatted_ids
-    
     # Step 7: Create interactive map
     print("\n--- Creating interactive map ---")
-    map_obj = create_interactive_map(bounds, rivers_data)
-    if map_obj:
-        print("Interactive map created! Check below.")
-        return map_obj
+    map_obj = create_interactive_map(bounds, rivers_data, rem_tiles=rem_tiles,
+                                     rem_max_zoom=rem_max_zoom)
+    if map_obj and map_path:
+        map_obj.save(map_path)
+        print(f"Interactive map saved to {map_path}")
     
-    return rivers_data
+    return formatted_ids
 
 # Run the main function with your specific file
 if __name__ == "__main__":
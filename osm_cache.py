@@ -0,0 +1,202 @@
+# Persistent on-disk cache for OSM river queries
+# Entries are content-addressed by a hash of the normalised query (an OSM ID
+# or a bbox + tag query). GeoDataFrames are stored as GeoParquet, everything
+# else as JSON, and a small index.json tracks age and size for eviction. The
+# index is only rewritten under a file lock; hits just touch the entry file.
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # Windows - no cross-process lock, unique temp files still apply
+    fcntl = None
+
+CACHE_DIR = Path(os.environ.get('REM_OSM_CACHE', Path.home() / '.cache' / 'rem' / 'osm'))
+CACHE_TTL = 30 * 24 * 3600          # seconds
+CACHE_MAX_BYTES = 512 * 1024 ** 2   # total size before the oldest entries are evicted
+
+
+def osm_id_key(osm_id):
+    """Cache key for a single OSM element, e.g. 'R2183775'"""
+    return f"osmid:{str(osm_id).strip().upper()}"
+
+
+def bbox_key(bbox, tags, precision=5):
+    """Cache key for a bbox + tag query
+
+    The bbox is rounded so that float noise doesn't defeat the cache, and
+    tags are sorted so their order doesn't matter.
+    """
+    bbox = [round(float(v), precision) for v in bbox]
+    return 'bbox:' + json.dumps({'bbox': bbox, 'tags': tags}, sort_keys=True, default=str)
+
+
+def _digest(key):
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+@contextmanager
+def _index_lock(cache_dir):
+    """Exclusive lock around index read-modify-write (shared by every process)"""
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    with open(cache_dir / 'index.lock', 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _load_index(cache_dir):
+    index_path = Path(cache_dir) / 'index.json'
+    try:
+        return json.loads(index_path.read_text())
+    except FileNotFoundError:
+        pass
+    except ValueError:
+        pass  # Corrupt index - start over, orphaned files get overwritten
+    return {}
+
+
+def _atomic_write(path, data):
+    """Write bytes to path through a unique temp file, so concurrent writers never collide"""
+    path = Path(path)
+    with tempfile.NamedTemporaryFile(dir=path.parent, prefix=path.name + '.', suffix='.tmp',
+                                     delete=False) as tmp:
+        tmp.write(data)
+    os.replace(tmp.name, path)
+
+
+def _save_index(cache_dir, index):
+    _atomic_write(Path(cache_dir) / 'index.json', json.dumps(index, indent=1).encode('utf-8'))
+
+
+def _remove_entry(cache_dir, index, digest):
+    entry = index.pop(digest)
+    try:
+        (Path(cache_dir) / entry['file']).unlink()
+    except FileNotFoundError:
+        pass
+
+
+def _last_used(cache_dir, entry):
+    """Last use of an entry - hits touch the entry file instead of rewriting the index"""
+    try:
+        return (Path(cache_dir) / entry['file']).stat().st_mtime
+    except FileNotFoundError:
+        return 0.0
+
+
+def cache_get(key, cache_dir=CACHE_DIR, ttl=CACHE_TTL):
+    """Cached value for key, or None if missing or older than ttl seconds"""
+    digest = _digest(key)
+    entry = _load_index(cache_dir).get(digest)
+    if entry is None:
+        return None
+
+    path = Path(cache_dir) / entry['file']
+    if (ttl is not None and time.time() - entry['created'] > ttl) or not path.exists():
+        with _index_lock(cache_dir):
+            index = _load_index(cache_dir)
+            if digest in index:
+                _remove_entry(cache_dir, index, digest)
+                _save_index(cache_dir, index)
+        return None
+
+    try:
+        if entry['format'] == 'parquet':
+            import geopandas as gpd
+            value = gpd.read_parquet(path)
+        else:
+            value = json.loads(path.read_text())
+        os.utime(path)  # Mark as recently used for LRU eviction
+    except (FileNotFoundError, ValueError):
+        return None  # Evicted or replaced by another process meanwhile
+    return value
+
+
+def cache_put(key, value, cache_dir=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+    """Store value under key, evicting least recently used entries past max_bytes"""
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    digest = _digest(key)
+
+    if hasattr(value, 'to_parquet') and hasattr(value, 'geometry'):
+        import io
+        file_format, filename = 'parquet', f"{digest}.parquet"
+        buffer = io.BytesIO()
+        value.to_parquet(buffer)
+        _atomic_write(cache_dir / filename, buffer.getvalue())
+    else:
+        file_format, filename = 'json', f"{digest}.json"
+        _atomic_write(cache_dir / filename, json.dumps(value, default=str).encode('utf-8'))
+
+    with _index_lock(cache_dir):
+        index = _load_index(cache_dir)
+        index[digest] = {
+            'key': key,
+            'file': filename,
+            'format': file_format,
+            'size': (cache_dir / filename).stat().st_size,
+            'created': time.time(),
+        }
+
+        # Size-based eviction, least recently used first
+        total = sum(entry['size'] for entry in index.values())
+        for old in sorted(index, key=lambda d: _last_used(cache_dir, index[d])):
+            if total <= max_bytes:
+                break
+            if old == digest:
+                continue
+            total -= index[old]['size']
+            _remove_entry(cache_dir, index, old)
+
+        _save_index(cache_dir, index)
+    return value
+
+
+def cached(key, fetch, cache_dir=CACHE_DIR, ttl=CACHE_TTL, refresh=False):
+    """Return the cached value for key, calling fetch() and storing it on a miss
+
+    Empty results are not cached, so a failed lookup is retried next time.
+    """
+    if not refresh:
+        value = cache_get(key, cache_dir=cache_dir, ttl=ttl)
+        if value is not None:
+            return value
+
+    value = fetch()
+    if value is not None and len(value) > 0:
+        cache_put(key, value, cache_dir=cache_dir)
+    return value
+
+
+def clear_cache(cache_dir=CACHE_DIR):
+    """Remove every cached entry"""
+    with _index_lock(cache_dir):
+        index = _load_index(cache_dir)
+        for digest in list(index):
+            _remove_entry(cache_dir, index, digest)
+        _save_index(cache_dir, index)
+
+
+def geocode_osm_id(osm_id, cache_dir=CACHE_DIR, ttl=CACHE_TTL, refresh=False):
+    """Cached ox.geocode_to_gdf(osm_id, by_osmid=True)
+
+    osmnx is only imported on a cache miss, so cached IDs work offline
+    without it.
+    """
+    def fetch():
+        import osmnx as ox
+        return ox.geocode_to_gdf(osm_id, by_osmid=True)
+
+    return cached(osm_id_key(osm_id), fetch, cache_dir=cache_dir, ttl=ttl, refresh=refresh)
@@ -1,6 +1,9 @@
 osm_id = 'R2183775' 
 
-river = ox.geocode_to_gdf(osm_id, by_osmid=True)
+from osm_cache import geocode_osm_id
+
+# Served from the local OSM cache after the first run
+river = geocode_osm_id(osm_id)
 river = river.to_crs(dem.rio.crs)
 
 
@@ -0,0 +1,227 @@
+# Concurrent Overpass API client
+# One pooled aiohttp session, bounded concurrency, retry with backoff on
+# rate limiting / gateway timeouts, and way geometries fetched in batches
+# with a single `way(id:...)` query instead of one request per way.
+
+import asyncio
+import os
+import threading
+
+import aiohttp
+
+OVERPASS_URL = os.environ.get('OVERPASS_URL', "http://overpass-api.de/api/interpreter")
+RIVER_TYPES = ['river', 'stream', 'creek', 'brook', 'canal']
+RETRY_STATUSES = {429, 502, 503, 504}
+
+
+def run_async(coro):
+    """Run a coroutine to completion, also from inside a running event loop
+
+    Notebooks (Colab/Jupyter) already run a loop, where asyncio.run fails,
+    so in that case the coroutine runs on a helper thread.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+
+    result = {}
+
+    def target():
+        try:
+            result['value'] = asyncio.run(coro)
+        except BaseException as e:
+            result['error'] = e
+
+    thread = threading.Thread(target=target)
+    thread.start()
+    thread.join()
+    if 'error' in result:
+        raise result['error']
+    return result['value']
+
+
+def make_session(concurrency=4, timeout=90):
+    """aiohttp session with a pooled connector limited to `concurrency` connections"""
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    return aiohttp.ClientSession(connector=connector,
+                                 timeout=aiohttp.ClientTimeout(total=timeout))
+
+
+async def overpass_query(session, query, semaphore=None, retries=4, backoff=2.0,
+                         url=OVERPASS_URL):
+    """POST an Overpass QL query and return the decoded JSON
+
+    429/502/503/504 responses, timeouts and connection errors are retried
+    with exponential backoff, honouring Retry-After when the server sends it.
+    """
+    semaphore = semaphore or asyncio.Semaphore(1)
+
+    for attempt in range(retries + 1):
+        retry_after = None
+        try:
+            async with semaphore:
+                async with session.post(url, data={'data': query}) as response:
+                    if response.status == 200:
+                        return await response.json(content_type=None)
+                    if response.status not in RETRY_STATUSES or attempt == retries:
+                        response.raise_for_status()
+                    retry_after = response.headers.get('Retry-After')
+        except aiohttp.ClientResponseError:
+            raise  # Non-retryable status, or out of retries
+        except (asyncio.TimeoutError, aiohttp.ClientError):
+            if attempt == retries:
+                raise
+
+        delay = float(retry_after) if retry_after and retry_after.isdigit() else backoff * 2 ** attempt
+        await asyncio.sleep(delay)
+
+
+def river_info_from_element(element, method):
+    """The river dict used by make_osmid.py, built from an Overpass element"""
+    tags = element.get('tags', {})
+    return {
+        'osm_id': element['id'],
+        'osm_type': element['type'],
+        'name': tags.get('name', 'Unnamed'),
+        'waterway_type': tags.get('waterway'),
+        'coordinates': [(node['lon'], node['lat']) for node in element.get('geometry', [])],
+        'tags': tags,
+        'method': method,
+    }
+
+
+def bbox_query(bbox, named_only=False, timeout=90):
+    """Overpass QL for waterways in bbox (south, west, north, east)"""
+    name_filter = '["name"]' if named_only else ''
+    s, w, n, e = bbox
+    return f"""
+    [out:json][timeout:{timeout}];
+    (
+      way["waterway"]{name_filter}({s},{w},{n},{e});
+      relation["waterway"]{name_filter}({s},{w},{n},{e});
+    );
+    out tags center;
+    """
+
+
+def way_geometry_query(way_ids, timeout=90):
+    """Overpass QL fetching the geometry of many ways in one request"""
+    ids = ','.join(str(way_id) for way_id in way_ids)
+    return f"""
+    [out:json][timeout:{timeout}];
+    way(id:{ids});
+    out geom;
+    """
+
+
+async def fetch_way_geometries_async(way_ids, batch_size=200, concurrency=2, session=None):
+    """{way_id: [(lon, lat), ...]} for every way, in len(way_ids) / batch_size requests"""
+    way_ids = list(dict.fromkeys(int(way_id) for way_id in way_ids))
+    batches = [way_ids[i:i + batch_size] for i in range(0, len(way_ids), batch_size)]
+    if not batches:
+        return {}
+
+    own_session = session is None
+    session = session or make_session(concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+    try:
+        results = await asyncio.gather(*[
+            overpass_query(session, way_geometry_query(batch), semaphore) for batch in batches
+        ])
+    finally:
+        if own_session:
+            await session.close()
+
+    geometries = {}
+    for data in results:
+        for element in data.get('elements', []):
+            if element.get('type') == 'way':
+                geometries[element['id']] = [(node['lon'], node['lat'])
+                                             for node in element.get('geometry', [])]
+    return geometries
+
+
+async def find_rivers_async(bbox, concurrency=4, with_geometry=True, osmnx_fallback=True):
+    """Rivers in bbox from Overpass, with sequential fallbacks
+
+    All waterways are queried first; the named-only query and then OSMnx
+    are only tried when the previous method fails or finds nothing, so the
+    result doesn't depend on timing and the named-only subset never
+    replaces a full answer. Way geometries are then fetched in batched
+    requests.
+    """
+    async with make_session(concurrency) as session:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def overpass_method(named_only, method):
+            data = await overpass_query(session, bbox_query(bbox, named_only), semaphore)
+            return [river_info_from_element(element, method)
+                    for element in data.get('elements', [])
+                    if element.get('tags', {}).get('waterway') in RIVER_TYPES]
+
+        methods = [('overpass_simple', lambda: overpass_method(False, 'overpass_simple')),
+                   ('direct_http', lambda: overpass_method(True, 'direct_http'))]
+        if osmnx_fallback:
+            methods.append(('osmnx', lambda: asyncio.to_thread(_osmnx_rivers, bbox)))
+
+        rivers_data = []
+        for method, lookup in methods:
+            try:
+                rivers_data = await lookup()
+            except Exception as e:
+                print(f"River lookup method {method} failed: {e}")
+                continue
+            if rivers_data:
+                break
+
+        if with_geometry:
+            missing = [r['osm_id'] for r in rivers_data
+                       if r['osm_type'] == 'way' and not r['coordinates']]
+            geometries = await fetch_way_geometries_async(missing, concurrency=concurrency,
+                                                          session=session)
+            for river in rivers_data:
+                if river['osm_type'] == 'way' and not river['coordinates']:
+                    river['coordinates'] = geometries.get(river['osm_id'], [])
+
+    return rivers_data
+
+
+def _osmnx_rivers(bbox):
+    """OSMnx lookup (blocking - run in a thread by find_rivers_async)"""
+    import osmnx as ox
+
+    south, west, north, east = bbox
+    waterways_gdf = ox.features_from_bbox(north=north, south=south, east=east, west=west,
+                                          tags={'waterway': True})
+    rivers_data = []
+    for idx, row in waterways_gdf.iterrows():
+        waterway_type = row.get('waterway', '')
+        if waterway_type in RIVER_TYPES:
+            if isinstance(idx, tuple) and len(idx) >= 2:
+                osm_type = 'way' if idx[0] == 'way' else 'relation'
+                osm_id = idx[1]
+            else:
+                osm_type = 'way'
+                osm_id = idx
+            rivers_data.append({
+                'osm_id': osm_id,
+                'osm_type': osm_type,
+                'name': row.get('name', 'Unnamed'),
+                'waterway_type': waterway_type,
+                'coordinates': [],
+                'tags': {k: v for k, v in row.items() if isinstance(v, (str, int, float))},
+                'method': 'osmnx',
+            })
+    return rivers_data
+
+
+def find_rivers(bbox, concurrency=4, with_geometry=True):
+    """Blocking wrapper around find_rivers_async"""
+    return run_async(find_rivers_async(bbox, concurrency=concurrency, with_geometry=with_geometry))
+
+
+def fetch_way_geometries(way_ids, batch_size=200, concurrency=2):
+    """Blocking wrapper around fetch_way_geometries_async"""
+    return run_async(fetch_way_geometries_async(way_ids, batch_size=batch_size,
+                                                concurrency=concurrency))
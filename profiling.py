@@ -0,0 +1,209 @@
+# Per-stage timing, memory and throughput instrumentation
+# Wrap pipeline steps in `with stage('idw', cells=n):` or decorate them with
+# @profiled('idw'). Each stage records wall and CPU time, peak RSS, the
+# tracemalloc peak (when memory tracing is on) and cells per second. Results
+# can be printed, dumped as JSON or as a Chrome trace (chrome://tracing,
+# Perfetto). Disabled by default - a stage then costs one attribute check.
+# Enable with enable() or REM_PROFILE=1 (REM_PROFILE=memory also traces
+# Python allocations).
+
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+_state = {
+    'enabled': os.environ.get('REM_PROFILE', '') not in ('', '0'),
+    'trace_memory': os.environ.get('REM_PROFILE', '') == 'memory',
+}
+_records = []
+_local = threading.local()
+_origin = time.perf_counter()
+
+
+def enable(trace_memory=False):
+    """Start recording stages (trace_memory=True also tracks Python allocation peaks)"""
+    _state['enabled'] = True
+    _state['trace_memory'] = trace_memory
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable():
+    """Stop recording stages (already recorded results are kept)"""
+    _state['enabled'] = False
+    if _state['trace_memory'] and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _state['trace_memory'] = False
+
+
+def is_enabled():
+    return _state['enabled']
+
+
+def reset():
+    """Forget all recorded stages"""
+    del _records[:]
+
+
+def records():
+    """Recorded stages, in the order they finished"""
+    return list(_records)
+
+
+def _peak_rss():
+    """Peak resident set size of this process in bytes (None where unsupported)"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    import sys
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # kB on Linux
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+class stage:
+    """Context manager recording one pipeline stage
+
+    cells -- number of raster cells processed, for cells-per-second; can
+             also be set on the returned object inside the block
+    Extra keyword arguments are stored with the record.
+    """
+
+    def __init__(self, name, cells=None, **info):
+        self.name = name
+        self.cells = cells
+        self.info = info
+        self.active = False
+
+    def __enter__(self):
+        if not _state['enabled']:
+            return self
+        self.active = True
+        stack = _stack()
+        self.depth = len(stack)
+        stack.append(self)
+
+        self.traced_peak = 0
+        if _state['trace_memory'] and tracemalloc.is_tracing():
+            self.traced_start = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        self.cpu_start = time.process_time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if not self.active:
+            return False
+        wall = time.perf_counter() - self.start
+        cpu = time.process_time() - self.cpu_start
+        stack = _stack()
+        stack.pop()
+
+        record = {
+            'name': self.name,
+            'start': self.start - _origin,
+            'wall': wall,
+            'cpu': cpu,
+            'depth': self.depth,
+            'thread': threading.get_ident(),
+            'peak_rss': _peak_rss(),
+            'cells': self.cells,
+            'cells_per_second': self.cells / wall if self.cells and wall > 0 else None,
+            'error': exc_type.__name__ if exc_type else None,
+        }
+        if _state['trace_memory'] and tracemalloc.is_tracing():
+            # reset_peak() in nested stages hides their peak from this one,
+            # so children report theirs upwards on exit
+            peak = max(tracemalloc.get_traced_memory()[1], self.traced_peak)
+            record['traced_peak'] = peak - self.traced_start
+            if stack:
+                stack[-1].traced_peak = max(stack[-1].traced_peak, peak)
+        record.update(self.info)
+        _records.append(record)
+        self.active = False
+        return False
+
+
+def profiled(name=None, cells=None):
+    """Decorator recording every call as a stage
+
+    cells -- optional callable(result) giving the number of cells processed,
+             e.g. lambda out: out.size
+    """
+    def decorate(func):
+        stage_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _state['enabled']:
+                return func(*args, **kwargs)
+            with stage(stage_name) as s:
+                result = func(*args, **kwargs)
+                if cells is not None:
+                    s.cells = cells(result)
+            return result
+        return wrapper
+    return decorate
+
+
+def summary():
+    """Per-stage totals: calls, wall, cpu, cells and cells per second"""
+    totals = {}
+    for record in _records:
+        total = totals.setdefault(record['name'], {'calls': 0, 'wall': 0.0, 'cpu': 0.0,
+                                                   'cells': 0, 'peak_rss': 0})
+        total['calls'] += 1
+        total['wall'] += record['wall']
+        total['cpu'] += record['cpu']
+        total['cells'] += record['cells'] or 0
+        total['peak_rss'] = max(total['peak_rss'], record['peak_rss'] or 0)
+        if 'traced_peak' in record:
+            total['traced_peak'] = max(total.get('traced_peak', 0), record['traced_peak'])
+    for total in totals.values():
+        total['cells_per_second'] = total['cells'] / total['wall'] if total['cells'] and total['wall'] else None
+    return totals
+
+
+def report():
+    """Print the per-stage summary, slowest first"""
+    totals = summary()
+    print(f"{'stage':30s} {'calls':>5s} {'wall s':>9s} {'cpu s':>9s} {'Mcells/s':>9s} {'peak RSS MB':>12s}")
+    for name, total in sorted(totals.items(), key=lambda item: -item[1]['wall']):
+        rate = total['cells_per_second']
+        rate = f"{rate / 1e6:9.2f}" if rate else f"{'-':>9s}"
+        print(f"{name:30s} {total['calls']:5d} {total['wall']:9.3f} {total['cpu']:9.3f} {rate} "
+              f"{total['peak_rss'] / 1024 ** 2:12.1f}")
+
+
+def write_json(path):
+    """Dump the raw stage records and per-stage summary as JSON"""
+    with open(path, 'w') as f:
+        json.dump({'stages': _records, 'summary': summary()}, f, indent=1)
+    return path
+
+
+def write_chrome_trace(path):
+    """Write the stages as a Chrome trace (complete 'X' events, microseconds)"""
+    pid = os.getpid()
+    events = []
+    for record in _records:
+        args = {key: value for key, value in record.items()
+                if key not in ('name', 'start', 'wall', 'thread') and value is not None}
+        events.append({'name': record['name'], 'ph': 'X', 'pid': pid, 'tid': record['thread'],
+                       'ts': record['start'] * 1e6, 'dur': record['wall'] * 1e6, 'args': args})
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    return path
+
+
+if _state['trace_memory']:
+    tracemalloc.start()
@@ -0,0 +1,289 @@
+# Batch REM generation over many DEM tiles and rivers
+# Runs the notebook chain (DEM -> river -> sample -> IDW -> REM) as one
+# function per job, spreads jobs over a process pool and writes GeoTIFFs.
+# A completion marker per job lets an interrupted batch resume.
+#
+# Usage:
+#   python rem_batch.py "tiles/*.tif" --rivers R2183775 W123456 --out-dir rems
+#   python rem_batch.py tiles/a.tif tiles/b.tif --auto-rivers --workers 4
+#   python rem_batch.py dem.tif --rivers R2183775 --tiles mbtiles
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import numpy as np
+import xarray as xr
+from scipy.spatial import cKDTree as KDTree
+
+from cog import write_cog
+from corridor import load_corridor, points_in_mask
+from dem_io import open_raster, clip_window
+import profiling
+from tiles import build_tile_pyramid
+from surface import interpolate_surface
+from sampling import extract_river_pixels, sample_dem, sample_river_profile
+
+
+def load_river(osm_id, crs):
+    """River geometry for an OSM ID, reprojected to the DEM's CRS"""
+    from osm_cache import geocode_osm_id
+    return geocode_osm_id(osm_id).to_crs(crs)
+
+
+def detect_rivers(dem):
+    """OSM IDs ('W123'/'R123') of rivers inside the DEM bounds"""
+    import geopandas as gpd
+    from shapely.geometry import box
+    from osm_cache import bbox_key, cached
+    from overpass import find_rivers
+
+    bounds = gpd.GeoSeries([box(*dem.rio.bounds())], crs=dem.rio.crs).to_crs('EPSG:4326').total_bounds
+    minx, miny, maxx, maxy = bounds
+    bbox = (miny, minx, maxy, maxx)
+    rivers_data = cached(bbox_key(bbox, {'waterway': 'river'}),
+                         lambda: find_rivers(bbox, with_geometry=False))
+
+    return [('W' if river['osm_type'] == 'way' else 'R') + str(river['osm_id'])
+            for river in rivers_data if river['waterway_type'] == 'river']
+
+
+def build_rem(dem, river=None, buffer=0.01, quantile=0.95, k=5, tile_size=(512, 512),
+              n_workers=1, max_distance=None, corridor=None, sampling='profile', surface='idw',
+              power=1, kernel='numpy'):
+    """REM and interpolated river elevation for a DEM (and optional river geometry)
+
+    The DEM is clipped to the river bounds plus buffer when a river is
+    given, or with corridor (metres) to a buffer around the river itself,
+    in which case cells outside it are left as NaN. River elevations are
+    sampled along the river line ('profile') or, without a river line or
+    with sampling='pixels', from the top `quantile` of DEM cells. surface picks
+    the base-surface engine ('idw', 'nearest' or 'channel'); power and
+    kernel set the IDW power and weighting kernel. Returns
+    (rem, elevation_raster) DataArrays.
+    """
+    mask = None
+    if river is not None and corridor is not None:
+        dem, mask = load_corridor(dem, river, corridor)
+    elif river is not None:
+        dem = clip_window(dem, river.total_bounds, buffer=buffer)
+    dem_clipped = dem.squeeze().load()
+
+    # Profile sampling needs a line; other river geometries (e.g. riverbank
+    # polygons) fall back to the top DEM pixels
+    river_geom = river.geometry.union_all() if river is not None else None
+    profile = (sampling == 'profile' and river_geom is not None
+               and river_geom.geom_type in ('LineString', 'MultiLineString'))
+
+    if profile:
+        sampled_x, sampled_y, values, distance = sample_river_profile(dem_clipped, river_geom)
+    else:
+        x_real, y_real, rows, cols = extract_river_pixels(dem_clipped, quantile=quantile,
+                                                          return_indices=True)
+        sampled_x, sampled_y, values = sample_dem(dem_clipped, x_real, y_real,
+                                                  source=dem_clipped, rows=rows, cols=cols)
+    if mask is not None:
+        keep = points_in_mask(mask, dem_clipped, sampled_x, sampled_y)
+        sampled_x, sampled_y, values = sampled_x[keep], sampled_y[keep], values[keep]
+        if profile:
+            distance = distance[keep]
+    if len(values) == 0:
+        raise ValueError("No river samples found in DEM")
+
+    tree = KDTree(np.column_stack([sampled_x, sampled_y]))
+    c_x, c_y = dem_clipped.x.values, dem_clipped.y.values
+    if surface == 'idw':
+        options = dict(k=k, n_workers=n_workers, power=power, kernel=kernel)
+    elif surface == 'channel':
+        if not profile:
+            raise ValueError("The 'channel' surface needs a river line and profile sampling")
+        options = dict(stations=tree.data, distance=distance)
+    else:
+        options = {}
+    interpolated_values = interpolate_surface(surface, tree, values, c_x, c_y, tile_size=tile_size,
+                                              max_distance=max_distance, mask=mask, **options)
+
+    elevation_raster = xr.DataArray(interpolated_values, dims=('y', 'x'),
+                                    coords={'x': c_x, 'y': c_y})
+    elevation_raster = elevation_raster.rio.write_crs(dem_clipped.rio.crs)
+
+    rem = (dem_clipped - elevation_raster).astype(np.float32)
+    rem = rem.rio.write_crs(dem_clipped.rio.crs)
+
+    return rem, elevation_raster
+
+
+def job_name(dem_path, osm_id):
+    """Output name for a (DEM tile, river) job
+
+    A short hash of the resolved DEM path keeps same-named tiles from
+    different directories apart.
+    """
+    path = Path(dem_path).resolve()
+    digest = hashlib.sha1(str(path).encode('utf-8')).hexdigest()[:8]
+    return f"{path.stem}_{digest}_{osm_id or 'all'}"
+
+
+def run_job(job):
+    """Build and write the REM for one job, returning a status dict"""
+    start = time.perf_counter()
+    out_dir = Path(job['out_dir'])
+    name = job_name(job['dem'], job['osm_id'])
+    output = out_dir / f"{name}.tif"
+    marker = out_dir / f"{name}.done"
+
+    if job['profile']:
+        profiling.enable()
+        profiling.reset()
+
+    try:
+        # Masked, so DEM voids become NaN and are written as nodata, not as REM values
+        dem = open_raster(job['dem'], masked=True)
+        river = load_river(job['osm_id'], dem.rio.crs) if job['osm_id'] else None
+
+        rem, elevation_raster = build_rem(
+            dem, river, buffer=job['buffer'], quantile=job['quantile'], k=job['k'],
+            tile_size=job['tile_size'], n_workers=job['idw_workers'],
+            max_distance=job['max_distance'], corridor=job['corridor'],
+            sampling=job['sampling'], surface=job['surface'], power=job['power'],
+            kernel=job['kernel'],
+        )
+
+        # Write to temporary names so a crash never leaves a half-written tile
+        outputs = [(output, rem)]
+        if job['write_elevation']:
+            outputs.append((out_dir / f"{name}_elevation.tif", elevation_raster))
+        for path, raster in outputs:
+            tmp_path = path.with_suffix('.tmp.tif')
+            write_cog(tmp_path, raster, encoding=job['encoding'])
+            os.replace(tmp_path, path)
+
+        # Web-map tiles; reruns only re-render the tiles whose REM window changed
+        if job['tiles']:
+            tiles_output = out_dir / (f"{name}.mbtiles" if job['tiles'] == 'mbtiles'
+                                      else f"{name}_tiles")
+            build_tile_pyramid(rem, tiles_output, n_workers=job['idw_workers'])
+
+        result = {'job': name, 'status': 'done', 'output': str(output),
+                  'shape': list(rem.shape), 'seconds': time.perf_counter() - start}
+        if job['profile']:
+            profiling.write_json(out_dir / f"{name}.profile.json")
+            profiling.write_chrome_trace(out_dir / f"{name}.trace.json")
+        marker.write_text(json.dumps(result))
+        return result
+
+    except Exception as e:
+        return {'job': name, 'status': 'failed', 'error': str(e),
+                'traceback': traceback.format_exc(), 'seconds': time.perf_counter() - start}
+
+
+def expand_dems(patterns):
+    """DEM paths from a list of paths and glob patterns"""
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern))
+        paths.extend(matches if matches else [pattern])
+    return list(dict.fromkeys(paths))
+
+
+def make_jobs(args):
+    """One job per (DEM tile, river) pair"""
+    jobs = []
+    for dem_path in expand_dems(args.dems):
+        if args.rivers:
+            osm_ids = args.rivers
+        elif args.auto_rivers:
+            osm_ids = detect_rivers(open_raster(dem_path))
+            print(f"{dem_path}: detected rivers {osm_ids}")
+        else:
+            osm_ids = [None]
+
+        for osm_id in osm_ids:
+            jobs.append({
+                'dem': dem_path, 'osm_id': osm_id, 'out_dir': args.out_dir,
+                'buffer': args.buffer, 'quantile': args.quantile, 'k': args.k,
+                'tile_size': (args.tile_size, args.tile_size),
+                'idw_workers': args.idw_workers, 'max_distance': args.max_distance,
+                'corridor': args.corridor, 'sampling': args.sampling, 'surface': args.surface,
+                'power': args.power, 'kernel': args.kernel,
+                'write_elevation': args.write_elevation, 'encoding': args.encoding,
+                'tiles': args.tiles, 'profile': args.profile,
+            })
+    return jobs
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Batch REM generation over DEM tiles")
+    parser.add_argument('dems', nargs='+', help="DEM GeoTIFF paths or glob patterns")
+    parser.add_argument('--rivers', nargs='*', default=[],
+                        help="OSM IDs, e.g. R2183775 W123456 (applied to every tile)")
+    parser.add_argument('--auto-rivers', action='store_true',
+                        help="Look up rivers inside each tile in OSM")
+    parser.add_argument('--out-dir', default='rem_output')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="Jobs processed in parallel")
+    parser.add_argument('--idw-workers', type=int, default=1,
+                        help="Threads per job for the IDW step")
+    parser.add_argument('--buffer', type=float, default=0.01,
+                        help="Buffer around the river bounds, in DEM units")
+    parser.add_argument('--sampling', choices=['profile', 'pixels'], default='profile',
+                        help="Sample along the river line, or from the highest DEM pixels")
+    parser.add_argument('--surface', choices=['idw', 'nearest', 'channel'], default='idw',
+                        help="Base water-surface engine")
+    parser.add_argument('--power', type=float, default=1.0, help="IDW power")
+    parser.add_argument('--kernel', choices=['numpy', 'fused'], default='numpy',
+                        help="IDW weighting kernel ('fused' is single-pass, Numba-compiled if installed)")
+    parser.add_argument('--quantile', type=float, default=0.95)
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--tile-size', type=int, default=512)
+    parser.add_argument('--max-distance', type=float, default=None)
+    parser.add_argument('--corridor', type=float, default=None,
+                        help="Only process cells within this many metres of the river")
+    parser.add_argument('--write-elevation', action='store_true',
+                        help="Also write the interpolated river elevation raster")
+    parser.add_argument('--encoding', choices=['float32', 'int16'], default='float32',
+                        help="COG sample encoding (int16 is scaled to centimetres when the value "
+                             "range fits, coarser otherwise)")
+    parser.add_argument('--tiles', nargs='?', choices=['xyz', 'mbtiles'], const='xyz',
+                        default=None,
+                        help="Also render a web-map tile pyramid of each REM (<job>_tiles/z/x/y "
+                             "or <job>.mbtiles)")
+    parser.add_argument('--force', action='store_true',
+                        help="Rerun jobs that already have a completion marker")
+    parser.add_argument('--profile', action='store_true',
+                        help="Write per-stage timings (<job>.profile.json, <job>.trace.json)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    Path(args.out_dir).mkdir(parents=True, exist_ok=True)
+
+    jobs = make_jobs(args)
+    todo = [job for job in jobs
+            if args.force or not (Path(args.out_dir) / f"{job_name(job['dem'], job['osm_id'])}.done").exists()]
+    print(f"{len(jobs)} jobs, {len(jobs) - len(todo)} already done, running {len(todo)}")
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = [pool.submit(run_job, job) for job in todo]
+        for future in as_completed(futures):
+            result = future.result()
+            if result['status'] == 'done':
+                print(f"[done]   {result['job']} {result['shape']} in {result['seconds']:.1f} s")
+            else:
+                failed += 1
+                print(f"[failed] {result['job']}: {result['error']}")
+
+    print(f"Finished: {len(todo) - failed} succeeded, {failed} failed")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,162 @@
+# One-pass, mergeable raster statistics
+# Min/max/mean/variance are accumulated chunk by chunk (Chan/Welford merge),
+# and quantiles come from a fixed-width histogram that merges exactly across
+# chunks and tiles, so a single read of the data answers every summary.
+
+import numpy as np
+
+from profiling import profiled
+
+
+def _coarsen_histogram(start, counts, factor):
+    """Merge every `factor` adjacent bins of a histogram starting at bin `start`"""
+    new_start = start // factor
+    lead = start - new_start * factor
+    padded = np.zeros(-(-(lead + counts.size) // factor) * factor, dtype=np.int64)
+    padded[lead:lead + counts.size] = counts
+    return new_start, padded.reshape(-1, factor).sum(axis=1)
+
+
+class RasterStats:
+    """Streaming statistics accumulator
+
+    bin_width sets the quantile resolution: quantiles are exact to within
+    one bin (default 1 cm for REMs in metres). If the data spans more than
+    max_bins bins the width is doubled as often as needed, so memory stays
+    bounded even with outliers such as unmasked nodata values.
+    """
+
+    def __init__(self, bin_width=0.01, max_bins=2 ** 20):
+        self.bin_width = bin_width
+        self.max_bins = max_bins
+        self.count = 0
+        self.nan_count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+        self.hist_start = 0       # Bin index of hist_counts[0]
+        self.hist_counts = np.zeros(0, dtype=np.int64)
+
+    def update(self, chunk):
+        """Add a chunk of values (any shape, NaN ignored)"""
+        chunk = np.asarray(getattr(chunk, 'values', chunk), dtype=np.float64).ravel()
+        finite = np.isfinite(chunk)
+        self.nan_count += int(chunk.size - np.count_nonzero(finite))
+        chunk = chunk[finite]
+        if chunk.size == 0:
+            return self
+
+        chunk_mean = chunk.mean()
+        deviations = chunk - chunk_mean
+        self._merge_moments(chunk.size, chunk_mean, float(np.dot(deviations, deviations)))
+        self.min = min(self.min, float(chunk.min()))
+        self.max = max(self.max, float(chunk.max()))
+
+        span = (self.max - self.min) / self.bin_width
+        if span >= self.max_bins:
+            self._widen(2 ** int(np.ceil(np.log2((span + 1) / self.max_bins))))
+
+        bins = np.floor(chunk / self.bin_width).astype(np.int64)
+        start = int(bins.min())
+        self._merge_histogram(start, np.bincount(bins - start))
+        return self
+
+    def merge(self, other):
+        """Fold another accumulator (e.g. from another tile) into this one"""
+        start, counts = other.hist_start, other.hist_counts
+        if other.bin_width != self.bin_width:
+            ratio = max(other.bin_width, self.bin_width) / min(other.bin_width, self.bin_width)
+            factor = int(round(ratio))
+            if abs(ratio - factor) > 1e-9:
+                raise ValueError("Cannot merge statistics whose bin widths are not multiples")
+            if other.bin_width > self.bin_width:
+                self._widen(factor)
+            elif counts.size:
+                start, counts = _coarsen_histogram(start, counts, factor)
+
+        self.nan_count += other.nan_count
+        if other.count:
+            self._merge_moments(other.count, other.mean, other.m2)
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+            self._merge_histogram(start, counts)
+            while self.hist_counts.size > self.max_bins:
+                self._widen(2)
+        return self
+
+    def _widen(self, factor):
+        """Multiply the bin width by an integer factor"""
+        if self.hist_counts.size:
+            self.hist_start, self.hist_counts = _coarsen_histogram(
+                self.hist_start, self.hist_counts, factor)
+        self.bin_width *= factor
+
+    def _merge_moments(self, n, mean, m2):
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean += delta * n / total
+        self.m2 += m2 + delta * delta * self.count * n / total
+        self.count = total
+
+    def _merge_histogram(self, start, counts):
+        if self.hist_counts.size == 0:
+            self.hist_start, self.hist_counts = start, counts.astype(np.int64)
+            return
+
+        new_start = min(self.hist_start, start)
+        new_stop = max(self.hist_start + self.hist_counts.size, start + counts.size)
+        merged = np.zeros(new_stop - new_start, dtype=np.int64)
+        merged[self.hist_start - new_start:self.hist_start - new_start + self.hist_counts.size] += self.hist_counts
+        merged[start - new_start:start - new_start + counts.size] += counts
+        self.hist_start, self.hist_counts = new_start, merged
+
+    @property
+    def variance(self):
+        return self.m2 / self.count if self.count else np.nan
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+    def quantile(self, q):
+        """Approximate quantile(s), q in [0, 1], interpolated within a bin"""
+        q = np.asarray(q, dtype=np.float64)
+        if self.count == 0:
+            return np.full(q.shape, np.nan) if q.ndim else np.nan
+
+        cumulative = np.cumsum(self.hist_counts)
+        target = q * self.count
+        idx = np.clip(np.searchsorted(cumulative, target, side='left'), 0, cumulative.size - 1)
+        below = np.where(idx > 0, cumulative[idx - 1], 0)
+        fraction = (target - below) / np.maximum(self.hist_counts[idx], 1)
+
+        value = (self.hist_start + idx + fraction) * self.bin_width
+        value = np.clip(value, self.min, self.max)
+        return value if value.ndim else float(value)
+
+    def percentile(self, p):
+        """Same as quantile, with p in [0, 100] like np.percentile"""
+        return self.quantile(np.asarray(p) / 100)
+
+    def summary(self, percentiles=(25, 50, 75, 85, 90)):
+        """Dict of every statistic, ready for printing or JSON"""
+        return {
+            'count': self.count,
+            'nan_count': self.nan_count,
+            'min': self.min if self.count else np.nan,
+            'max': self.max if self.count else np.nan,
+            'mean': self.mean if self.count else np.nan,
+            'std': float(self.std),
+            **{f"p{p}": float(self.percentile(p)) for p in percentiles},
+        }
+
+
+@profiled('raster_stats', cells=lambda stats: stats.count)
+def raster_stats(raster, chunk_rows=1024, bin_width=0.01):
+    """RasterStats for a 2-D array or (lazy) DataArray, read chunk_rows at a time"""
+    raster = raster.squeeze() if hasattr(raster, 'squeeze') else raster
+    stats = RasterStats(bin_width)
+    for r0 in range(0, raster.shape[0], chunk_rows):
+        stats.update(raster[r0:r0 + chunk_rows])
+    return stats
@@ -0,0 +1,134 @@
+# Headless REM + hillshade renderer
+# REM values are quantised to uint8 indices into a precomputed RGBA lookup
+# table and alpha-blended over the hillshade in integer arithmetic, then
+# written straight to PNG/WebP - no matplotlib figures involved.
+
+import numpy as np
+
+from profiling import profiled
+
+REM_COLORS = ['#f2f7fb', '#81a8cb', '#37123d']
+
+
+def hex_to_rgb(color):
+    """'#81a8cb' -> (129, 168, 203)"""
+    color = color.lstrip('#')
+    return tuple(int(color[i:i + 2], 16) for i in (0, 2, 4))
+
+
+def make_lut(colors=REM_COLORS, size=256, alpha=255):
+    """(size, 4) uint8 RGBA table, linearly interpolated between evenly spaced colors
+
+    Matches LinearSegmentedColormap.from_list("custom", colors).
+    """
+    stops = np.array([hex_to_rgb(c) for c in colors], dtype=np.float64)
+    positions = np.linspace(0, 1, len(colors))
+    samples = np.linspace(0, 1, size)
+
+    lut = np.empty((size, 4), dtype=np.uint8)
+    for channel in range(3):
+        lut[:, channel] = np.round(np.interp(samples, positions, stops[:, channel]))
+    lut[:, 3] = alpha
+    return lut
+
+
+REM_LUT = make_lut()
+
+
+def quantize(values, vmin, vmax, levels=256):
+    """uint8 LUT indices for values, clipped to [vmin, vmax]
+
+    vmin may be larger than vmax to reverse the colour ramp. Also returns a
+    boolean mask of the NaN cells.
+    """
+    values = np.asarray(values, dtype=np.float32)
+    nan_mask = np.isnan(values)
+
+    span = np.float32(vmax - vmin) or np.float32(1)
+    scaled = values - np.float32(vmin)
+    scaled *= np.float32((levels - 1) / span)
+    np.clip(scaled, 0, levels - 1, out=scaled)
+    scaled[nan_mask] = 0
+
+    return scaled.astype(np.uint8), nan_mask
+
+
+def shade_gray(hillshade):
+    """Hillshade in [0, 1] -> uint8 grey levels"""
+    gray = np.asarray(hillshade, dtype=np.float32) * 255
+    return np.nan_to_num(gray, nan=0).clip(0, 255).astype(np.uint8)
+
+
+@profiled('render_rem', cells=lambda image: image.shape[0] * image.shape[1])
+def render_rem(rem, hillshade=None, vmin=None, vmax=None, lut=REM_LUT, alpha=200,
+               transparent=False):
+    """(rows, cols, 3) uint8 RGB image of the REM over the hillshade
+
+    alpha is the REM layer opacity in 0-255 (as in datashader's shade);
+    without a hillshade the REM is blended over white. With
+    transparent=True an RGBA image is returned whose NaN cells are fully
+    transparent (for map tiles).
+    """
+    rem = np.asarray(getattr(rem, 'values', rem)).squeeze()
+    if vmin is None:
+        vmin = np.nanmin(rem)
+    if vmax is None:
+        vmax = np.nanmax(rem)
+
+    index, nan_mask = quantize(rem, vmin, vmax, levels=len(lut))
+    rgba = lut[index]  # Single gather through the LUT
+
+    if hillshade is None:
+        base = np.full(rem.shape, 255, dtype=np.uint16)
+    else:
+        base = shade_gray(np.asarray(getattr(hillshade, 'values', hillshade)).squeeze()).astype(np.uint16)
+
+    # Per-pixel alpha in 0-255, transparent where the REM is NaN
+    a = (rgba[..., 3].astype(np.uint16) * alpha + 127) // 255
+    a[nan_mask] = 0
+    inv_a = 255 - a
+
+    out = np.empty(rem.shape + (4 if transparent else 3,), dtype=np.uint8)
+    for channel in range(3):
+        blended = rgba[..., channel] * a
+        blended += base * inv_a
+        blended += 127
+        blended //= 255
+        out[..., channel] = blended
+    if transparent:
+        out[..., 3] = np.where(nan_mask, 0, 255)
+    return out
+
+
+@profiled('write_image')
+def write_image(path, image, quality=90):
+    """Write an RGB(A) uint8 array as PNG or WebP (chosen by extension)"""
+    from PIL import Image
+
+    kwargs = {'quality': quality} if str(path).lower().endswith('.webp') else {'optimize': False}
+    Image.fromarray(image).save(path, **kwargs)
+    return path
+
+
+def encode_image(image, fmt='PNG', quality=90):
+    """RGB(A) uint8 array -> PNG/WebP bytes"""
+    import io
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    kwargs = {'quality': quality} if fmt.upper() == 'WEBP' else {}
+    Image.fromarray(image).save(buffer, format=fmt, **kwargs)
+    return buffer.getvalue()
+
+
+def decode_image(data):
+    """PNG/WebP bytes -> RGBA uint8 array"""
+    import io
+    from PIL import Image
+
+    return np.asarray(Image.open(io.BytesIO(data)).convert('RGBA'))
+
+
+def render_rem_image(path, rem, hillshade=None, vmin=None, vmax=None, lut=REM_LUT, alpha=200):
+    """render_rem and write the result to path"""
+    return write_image(path, render_rem(rem, hillshade, vmin, vmax, lut=lut, alpha=alpha))
@@ -0,0 +1,202 @@
+# River pixel extraction and DEM sampling helpers
+
+import numpy as np
+
+from profiling import profiled
+
+
+def river_pixel_indices(river_raster, quantile=0.95):
+    """Row and column indices of river pixels above the given quantile"""
+    data = np.asarray(river_raster.squeeze().values)
+    river_threshold = np.nanquantile(data, quantile)
+    return np.nonzero(data > river_threshold)
+
+
+def extract_river_pixels(river_raster, quantile=0.95, geometry=None, crs=None,
+                         return_indices=False):
+    """Coordinates of river pixels above the given quantile
+
+    Returns (x_real, y_real) coordinate arrays. Point geometry is only built
+    when asked for, in a single vectorized call:
+        geometry='points'    -- also return a shapely 2.x array of Points
+        geometry='geoseries' -- also return a GeoSeries (in crs)
+    With return_indices=True the pixel (rows, cols) are appended as well,
+    for use with sample_dem.
+    """
+    y_coords, x_coords = river_pixel_indices(river_raster, quantile)
+
+    # Convert array indices to actual coordinates
+    x_real = river_raster.x.values[x_coords]
+    y_real = river_raster.y.values[y_coords]
+
+    result = [x_real, y_real]
+
+    if geometry == 'points':
+        import shapely
+        result.append(shapely.points(x_real, y_real))
+    elif geometry == 'geoseries':
+        import geopandas as gpd
+        result.append(gpd.GeoSeries(gpd.points_from_xy(x_real, y_real), crs=crs))
+    elif geometry is not None:
+        raise ValueError(f"Unknown geometry type: {geometry!r} (use 'points' or 'geoseries')")
+
+    if return_indices:
+        result.extend([y_coords, x_coords])
+
+    return tuple(result)
+
+
+def pixel_offset(source, target):
+    """(row, col) offset of source's grid inside target's, or None if not aligned
+
+    Both rasters must share CRS, resolution and rotation, and their origins
+    must differ by a whole number of pixels.
+    """
+    if source.rio.crs != target.rio.crs:
+        return None
+
+    s = source.rio.transform()
+    t = target.rio.transform()
+    if not np.allclose([s.a, s.b, s.d, s.e], [t.a, t.b, t.d, t.e]) or t.b != 0 or t.d != 0:
+        return None
+
+    col_offset = (s.c - t.c) / t.a
+    row_offset = (s.f - t.f) / t.e
+    if abs(col_offset - round(col_offset)) > 1e-6 or abs(row_offset - round(row_offset)) > 1e-6:
+        return None
+
+    return int(round(row_offset)), int(round(col_offset))
+
+
+def xy_to_index(raster, x, y):
+    """Nearest (rows, cols) of raster for each (x, y) using its affine transform"""
+    inverse = ~raster.rio.transform()
+    cols = np.floor(inverse.a * x + inverse.b * y + inverse.c).astype(np.int64)
+    rows = np.floor(inverse.d * x + inverse.e * y + inverse.f).astype(np.int64)
+    return rows, cols
+
+
+def valid_samples(values, nodata=None):
+    """Mask of sampled values that are neither NaN nor the raster's nodata value"""
+    valid = np.ones(len(values), dtype=bool)
+    if np.issubdtype(values.dtype, np.floating):
+        valid &= ~np.isnan(values)
+    if nodata is not None and not np.isnan(nodata):
+        valid &= values != nodata
+    return valid
+
+
+def sample_dem(dem, x, y, source=None, rows=None, cols=None):
+    """Nearest-cell DEM values at the points (x, y)
+
+    When (rows, cols) index the points in a `source` raster that sits on the
+    same grid as dem, values are gathered by integer offset. Otherwise the
+    indices are computed from the coordinates through dem's affine
+    transform. Points outside the DEM or on NaN or nodata cells are dropped.
+
+    Returns the kept (x, y, values) arrays.
+    """
+    x = np.asarray(x)
+    y = np.asarray(y)
+    data = np.asarray(dem.squeeze().values)
+
+    offset = None
+    if source is not None and rows is not None and cols is not None:
+        offset = pixel_offset(source, dem)
+
+    if offset is not None:
+        dem_rows = np.asarray(rows) + offset[0]
+        dem_cols = np.asarray(cols) + offset[1]
+    else:
+        dem_rows, dem_cols = xy_to_index(dem, x, y)
+
+    inside = ((dem_rows >= 0) & (dem_rows < data.shape[0]) &
+              (dem_cols >= 0) & (dem_cols < data.shape[1]))
+    x, y = x[inside], y[inside]
+
+    # Single fancy-index gather
+    values = data[dem_rows[inside], dem_cols[inside]]
+
+    valid = valid_samples(values, dem.rio.nodata)
+    return x[valid], y[valid], values[valid]
+
+
+def densify_line(geometry, spacing):
+    """Points every `spacing` units along a (Multi)LineString, using vectorized shapely ops
+
+    Returns (x, y, distance, part): distance is the chainage along the
+    line, with the parts laid end to end, and part numbers the merged
+    line parts.
+    """
+    import shapely
+
+    merged = shapely.line_merge(geometry) if geometry.geom_type == 'MultiLineString' else geometry
+    parts = shapely.get_parts(merged)
+    if not all(part.geom_type == 'LineString' for part in parts):
+        raise ValueError(f"Expected line geometry, got {geometry.geom_type}")
+
+    lines, distances, part_ids = [], [], []
+    for i, part in enumerate(parts):
+        part_distances = np.append(np.arange(0, part.length, spacing), part.length)
+        lines.append(np.full(len(part_distances), part, dtype=object))
+        distances.append(part_distances)
+        part_ids.append(np.full(len(part_distances), i))
+
+    distances = np.concatenate(distances)
+    points = shapely.line_interpolate_point(np.concatenate(lines), distances)
+    coords = shapely.get_coordinates(points)
+
+    # Chainage: offset each part by the total length of the parts before it
+    offsets = np.cumsum([0] + [part.length for part in parts[:-1]])
+    part_ids = np.concatenate(part_ids)
+    return coords[:, 0], coords[:, 1], distances + offsets[part_ids], part_ids
+
+
+def monotonic_profile(values, part=None):
+    """Force elevations to never rise downstream, separately for each line part
+
+    Downstream is taken as the direction in which the part's elevation
+    drops overall.
+    """
+    values = np.array(values, dtype=np.float64)
+    part = np.zeros(len(values), dtype=int) if part is None else np.asarray(part)
+
+    for p in np.unique(part):
+        idx = np.nonzero(part == p)[0]
+        profile = values[idx]
+        if profile[0] >= profile[-1]:
+            values[idx] = np.minimum.accumulate(profile)
+        else:
+            values[idx] = np.minimum.accumulate(profile[::-1])[::-1]
+    return values
+
+
+@profiled('sample_river_profile', cells=lambda result: len(result[2]))
+def sample_river_profile(dem, river_geom, spacing=None, smooth=True):
+    """DEM elevations sampled along the river line instead of from thresholded pixels
+
+    spacing defaults to one DEM cell. With smooth=True the profile is made
+    monotonic downstream, which removes bridges and DEM noise from the
+    water surface.
+
+    Returns (x, y, values, distance) arrays for the samples inside the DEM
+    and off its nodata cells.
+    """
+    if spacing is None:
+        spacing = min(abs(r) for r in dem.rio.resolution())
+
+    x, y, distance, part = densify_line(river_geom, spacing)
+    data = np.asarray(dem.squeeze().values)
+    rows, cols = xy_to_index(dem, x, y)
+
+    inside = (rows >= 0) & (rows < data.shape[0]) & (cols >= 0) & (cols < data.shape[1])
+    values = np.full(len(x), np.nan)
+    values[inside] = data[rows[inside], cols[inside]]
+
+    valid = valid_samples(values, dem.rio.nodata)
+    x, y, values, distance, part = x[valid], y[valid], values[valid], distance[valid], part[valid]
+
+    if smooth and len(values):
+        values = monotonic_profile(values, part)
+
+    return x, y, values, distance
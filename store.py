@@ -0,0 +1,210 @@
+# Persistent store for intermediate pipeline arrays
+# Sampled points, neighbour queries and interpolated surfaces are written once
+# as .npy files (or Zarr arrays) with a JSON sidecar holding dtype, shape,
+# CRS, transform, coordinates and fingerprints of the inputs they were built
+# from. Later cells, reruns after a kernel restart and worker processes reopen
+# them memory-mapped (zero-copy, read-only by default) instead of recomputing.
+
+import json
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+
+from knn_cache import array_digest
+
+try:
+    import zarr
+    HAS_ZARR = True
+except ImportError:
+    HAS_ZARR = False
+
+STORE_DIR = Path(os.environ.get('REM_STORE', 'rem_store'))
+
+
+def file_fingerprint(path):
+    """Cheap identity of an input file: path, size and modification time"""
+    stat = os.stat(path)
+    return f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def source_fingerprints(**sources):
+    """{name: fingerprint} for files (str/Path), arrays and plain JSON-able values"""
+    fingerprints = {}
+    for name, source in sources.items():
+        if isinstance(source, (str, Path)) and os.path.exists(source):
+            fingerprints[name] = file_fingerprint(source)
+        elif isinstance(source, np.ndarray) or hasattr(source, 'dims'):
+            fingerprints[name] = array_digest(np.asarray(getattr(source, 'values', source)))
+        else:
+            fingerprints[name] = json.dumps(source, sort_keys=True, default=str)
+    return fingerprints
+
+
+def _raster_meta(array):
+    """CRS, transform and 1-D coordinates of a DataArray, if it has them"""
+    meta = {}
+    if hasattr(array, 'dims'):
+        meta['dims'] = list(array.dims)
+        meta['coords'] = {dim: np.asarray(array[dim].values).tolist()
+                          for dim in array.dims if dim in array.coords}
+        rio = getattr(array, 'rio', None)
+        if rio is not None and rio.crs is not None:
+            meta['crs'] = rio.crs.to_wkt()
+            meta['transform'] = list(rio.transform())[:6]
+    return meta
+
+
+class ArrayStore:
+    """Named arrays under root as {name}.npy (or {name}.zarr) plus {name}.json metadata
+
+    backend -- 'npy' (memory-mapped) or 'zarr' (chunked, compressed; needs zarr)
+    """
+
+    def __init__(self, root=STORE_DIR, backend='npy'):
+        if backend == 'zarr' and not HAS_ZARR:
+            raise ImportError("The 'zarr' backend needs the zarr package")
+        if backend not in ('npy', 'zarr'):
+            raise ValueError(f"Unknown backend: {backend!r} (use 'npy' or 'zarr')")
+        self.root = Path(root)
+        self.backend = backend
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def path(self, name):
+        return self.root / f"{name}.{self.backend}"
+
+    def meta(self, name):
+        """Metadata of a stored array, or None"""
+        path = self.root / f"{name}.json"
+        return json.loads(path.read_text()) if path.exists() else None
+
+    def names(self):
+        return sorted(path.stem for path in self.root.glob('*.json'))
+
+    def __contains__(self, name):
+        meta = self.meta(name)
+        return meta is not None and meta.get('complete', False)
+
+    def _save_meta(self, name, meta):
+        path = self.root / f"{name}.json"
+        tmp_path = path.with_suffix('.tmp')
+        tmp_path.write_text(json.dumps(meta, default=str))
+        os.replace(tmp_path, path)
+
+    def _meta_for(self, name, shape, dtype, sources, info):
+        info = dict(info)
+        if info.get('transform') is not None:
+            info['transform'] = list(info['transform'])[:6]  # Affine -> [a, b, c, d, e, f]
+        if info.get('crs') is not None and hasattr(info['crs'], 'to_wkt'):
+            info['crs'] = info['crs'].to_wkt()
+        meta = {'name': name, 'backend': self.backend, 'shape': list(shape),
+                'dtype': np.dtype(dtype).str, 'sources': sources or {}, 'created': time.time(),
+                'complete': False}
+        meta.update(info)
+        return meta
+
+    def put(self, name, array, sources=None, chunks=(1024, 1024), **info):
+        """Store array (NumPy array, memmap or DataArray) and return it reopened read-only
+
+        sources -- fingerprints of the inputs (see source_fingerprints), checked
+                   by get; DataArray CRS, transform and coordinates are kept
+                   automatically, anything else can be passed as keywords
+        """
+        meta_info = _raster_meta(array)
+        meta_info.update(info)
+        data = np.asarray(getattr(array, 'values', array))
+        meta = self._meta_for(name, data.shape, data.dtype, sources, meta_info)
+        self._save_meta(name, meta)  # Marked incomplete until the data is written
+
+        path = self.path(name)
+        if self.backend == 'npy':
+            tmp_path = self.root / f"{name}.tmp.npy"
+            np.save(tmp_path, data)
+            os.replace(tmp_path, path)
+        else:
+            zarr.save_array(str(path), data, chunks=chunks[:data.ndim] if data.ndim else None)
+
+        meta['complete'] = True
+        self._save_meta(name, meta)
+        return self.get(name)
+
+    def create(self, name, shape, dtype=np.float32, sources=None, **info):
+        """Writable array of the given shape, stored in place (e.g. as out= for IDW)
+
+        Call commit(name) once it is filled; until then get() ignores it.
+        """
+        self._save_meta(name, self._meta_for(name, shape, dtype, sources, info))
+        if self.backend == 'npy':
+            return np.lib.format.open_memmap(self.path(name), mode='w+', dtype=dtype,
+                                             shape=tuple(shape))
+        return zarr.open_array(str(self.path(name)), mode='w', shape=tuple(shape), dtype=dtype)
+
+    def commit(self, name, array=None, **info):
+        """Mark an array from create() as complete (flushing it if given)"""
+        if array is not None and hasattr(array, 'flush'):
+            array.flush()
+        meta = self.meta(name)
+        meta.update(info)
+        meta['complete'] = True
+        self._save_meta(name, meta)
+
+    def get(self, name, sources=None, mode='r'):
+        """Stored array memory-mapped (or a Zarr array), or None
+
+        Returns None when the array is missing, was never completed, or was
+        built from other sources than the given fingerprints. mode='r+'
+        allows in-place updates.
+        """
+        meta = self.meta(name)
+        if meta is None or not meta.get('complete', False):
+            return None
+        if sources is not None and meta.get('sources') != sources:
+            return None
+
+        path = self.path(name)
+        if not path.exists():
+            return None
+        if self.backend == 'npy':
+            return np.load(path, mmap_mode=mode)
+        return zarr.open_array(str(path), mode=mode)
+
+    def get_dataarray(self, name, sources=None):
+        """Stored raster as a (lazy, memory-mapped) DataArray with its coordinates and CRS"""
+        import xarray as xr
+
+        data = self.get(name, sources=sources)
+        if data is None:
+            return None
+        meta = self.meta(name)
+        dims = meta.get('dims') or [f"dim_{i}" for i in range(len(meta['shape']))]
+        array = xr.DataArray(data, dims=dims, coords=meta.get('coords', {}))
+        if meta.get('crs'):
+            import rioxarray  # noqa: F401 - registers .rio
+            array = array.rio.write_crs(meta['crs'])
+        return array
+
+    def delete(self, name):
+        path = self.path(name)
+        if path.is_dir():
+            import shutil
+            shutil.rmtree(path)
+        elif path.exists():
+            path.unlink()
+        meta_path = self.root / f"{name}.json"
+        if meta_path.exists():
+            meta_path.unlink()
+
+    def clear(self):
+        """Remove every stored array"""
+        for name in self.names():
+            self.delete(name)
+
+
+def open_shared(path):
+    """Read-only memory map of a stored .npy array, for worker processes
+
+    Pass store.path(name) to the workers instead of the array itself; every
+    process then maps the same pages rather than receiving a pickled copy.
+    """
+    return np.load(path, mmap_mode='r')
@@ -0,0 +1,150 @@
+# Base (water) surface engines
+# 'idw' is the k-neighbour inverse distance weighting from idw.py. 'nearest'
+# gives every cell the elevation of its nearest river station (one k=1 query,
+# no weight arrays). 'channel' projects the cell onto the channel segment
+# between its nearest station and that station's neighbour along the river,
+# and interpolates linearly by position along the channel.
+
+import numpy as np
+
+from idw import iter_tiles, idw_interpolate_parallel
+from profiling import profiled
+
+
+def _tile_points(c_x, c_y, mask):
+    c_interpolate = np.dstack(np.meshgrid(c_x, c_y)).reshape(-1, 2)
+    if mask is not None:
+        mask = np.asarray(mask, dtype=bool).ravel()
+        c_interpolate = c_interpolate[mask]
+    return c_interpolate, mask
+
+
+def _query(tree, points, k, workers, max_distance):
+    kwargs = {}
+    if workers is not None:
+        kwargs['workers'] = workers
+    if max_distance is not None:
+        kwargs['distance_upper_bound'] = max_distance
+    return tree.query(points, k=k, **kwargs)
+
+
+def _fill(out, rows, cols, result, mask):
+    if mask is None:
+        out[rows, cols] = result.reshape(out[rows, cols].shape)
+    else:
+        tile = np.full(mask.size, np.nan)
+        tile[mask] = result
+        out[rows, cols] = tile.reshape(out[rows, cols].shape)
+
+
+@profiled('nearest_station', cells=lambda out: out.size)
+def nearest_station(tree, values, c_x, c_y, tile_size=(512, 512), out=None, workers=None,
+                    max_distance=None, mask=None):
+    """Elevation of the nearest river station for every cell
+
+    Same arguments as idw.idw_interpolate; cells further than max_distance
+    from every station, or outside mask, are NaN.
+    """
+    c_x, c_y = np.asarray(c_x), np.asarray(c_y)
+    values = np.append(np.asarray(values, dtype=np.float64).ravel(), np.nan)  # index n = not found
+    if out is None:
+        out = np.empty((len(c_y), len(c_x)), dtype=np.float32)
+
+    for rows, cols in iter_tiles(out.shape, tile_size):
+        tile_mask = None if mask is None else np.asarray(mask)[rows, cols]
+        points, tile_mask = _tile_points(c_x[cols], c_y[rows], tile_mask)
+        _, indices = _query(tree, points, 1, workers, max_distance)
+        _fill(out, rows, cols, values[np.ravel(indices)], tile_mask)
+
+    return out
+
+
+def channel_stations(stations, distance, max_gap=None):
+    """Index of each station's downstream neighbour along the channel (-1 if none)
+
+    Stations are consecutive when sorted by chainage and no further apart
+    than max_gap (default: 2.5x the median spacing), so separate river
+    parts are not joined.
+    """
+    stations = np.asarray(stations)
+    order = np.argsort(distance, kind='stable')
+    gaps = np.hypot(*(stations[order[1:]] - stations[order[:-1]]).T)
+    if max_gap is None:
+        max_gap = 2.5 * np.median(gaps) if len(gaps) else 0
+
+    following = np.full(len(stations), -1)
+    linked = gaps <= max_gap
+    following[order[:-1][linked]] = order[1:][linked]
+    return following
+
+
+@profiled('channel_blend', cells=lambda out: out.size)
+def channel_blend(tree, values, c_x, c_y, stations, distance, tile_size=(512, 512), out=None,
+                  workers=None, max_distance=None, mask=None, max_gap=None):
+    """Water surface interpolated along the channel
+
+    Each cell is projected onto the segment between its nearest station
+    and the station's neighbour along the channel (whichever side the
+    cell is on), and takes the linearly interpolated elevation there.
+
+    stations -- (n, 2) station coordinates, in tree order
+    distance -- chainage of each station along the river
+    """
+    c_x, c_y = np.asarray(c_x), np.asarray(c_y)
+    stations = np.asarray(stations, dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64).ravel()
+    if out is None:
+        out = np.empty((len(c_y), len(c_x)), dtype=np.float32)
+
+    # Neighbours in both directions along the channel
+    following = channel_stations(stations, distance, max_gap)
+    preceding = np.full(len(stations), -1)
+    preceding[following[following >= 0]] = np.nonzero(following >= 0)[0]
+
+    for rows, cols in iter_tiles(out.shape, tile_size):
+        tile_mask = None if mask is None else np.asarray(mask)[rows, cols]
+        points, tile_mask = _tile_points(c_x[cols], c_y[rows], tile_mask)
+        _, nearest = _query(tree, points, 1, workers, max_distance)
+        nearest = np.ravel(nearest)
+
+        found = nearest < len(stations)
+        result = np.full(len(points), np.nan)
+        nearest = nearest[found]
+        p = points[found]
+        a = stations[nearest]
+        result_found = values[nearest]
+
+        for neighbours in (following, preceding):
+            other = neighbours[nearest]
+            has = other >= 0
+            other = np.where(has, other, nearest)
+            ab = stations[other] - a
+            length2 = np.einsum('ij,ij->i', ab, ab)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                t = np.einsum('ij,ij->i', p - a, ab) / length2
+            use = has & (length2 > 0) & (t > 0)
+            t = np.clip(t[use], 0, 1)
+            start, end = values[nearest[use]], values[other[use]]
+            result_found[use] = start + t * (end - start)
+
+        result[found] = result_found
+        _fill(out, rows, cols, result, tile_mask)
+
+    return out
+
+
+SURFACE_METHODS = {
+    'idw': idw_interpolate_parallel,
+    'nearest': nearest_station,
+    'channel': channel_blend,
+}
+
+
+def interpolate_surface(method, tree, values, c_x, c_y, **kwargs):
+    """Run the base-surface engine called `method` ('idw', 'nearest' or 'channel')"""
+    try:
+        engine = SURFACE_METHODS[method]
+    except KeyError:
+        raise ValueError(f"Unknown surface method: {method!r} "
+                         f"(use one of {', '.join(SURFACE_METHODS)})") from None
+    return engine(tree, values, c_x, c_y, **kwargs)
@@ -0,0 +1,327 @@
+# XYZ web-map tile pyramid for REM visualisations
+# The REM and hillshade are reprojected once to Web Mercator on a grid aligned
+# with the max-zoom tiles, so every tile is a plain 256x256 window. Max-zoom
+# tiles are rendered in parallel; lower zooms are built by downsampling their
+# four children. A manifest of per-tile source hashes lets reruns skip tiles
+# whose inputs haven't changed and remove tiles that are no longer produced.
+# Tiles go to a z/x/y directory or MBTiles.
+
+import hashlib
+import json
+import math
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from affine import Affine
+from rasterio.enums import Resampling
+
+from render import REM_LUT, render_rem, encode_image, decode_image
+from profiling import profiled
+
+TILE_SIZE = 256
+WEB_MERCATOR = 'EPSG:3857'
+ORIGIN = 20037508.342789244            # Half the Web Mercator world width, in metres
+RESOLUTION_Z0 = 2 * ORIGIN / TILE_SIZE  # Metres per pixel at zoom 0
+
+
+def tile_extent(z):
+    """Width of one tile at zoom z, in metres"""
+    return 2 * ORIGIN / 2 ** z
+
+
+def zoom_for_resolution(resolution):
+    """Smallest zoom whose pixels are at least as fine as resolution (metres)"""
+    return max(0, math.ceil(math.log2(RESOLUTION_Z0 / resolution)))
+
+
+def tile_range(bounds, z):
+    """(x_min, y_min, x_max, y_max) tile indices covering Web Mercator bounds"""
+    left, bottom, right, top = bounds
+    extent = tile_extent(z)
+    n = 2 ** z
+    x_min = int(np.clip(math.floor((left + ORIGIN) / extent), 0, n - 1))
+    x_max = int(np.clip(math.floor((right + ORIGIN) / extent - 1e-9), 0, n - 1))
+    y_min = int(np.clip(math.floor((ORIGIN - top) / extent), 0, n - 1))
+    y_max = int(np.clip(math.floor((ORIGIN - bottom) / extent - 1e-9), 0, n - 1))
+    return x_min, y_min, x_max, y_max
+
+
+def to_tile_grid(raster, z, resampling=Resampling.bilinear):
+    """Reproject raster to Web Mercator on a grid aligned with the zoom-z tiles
+
+    Returns (array, (x_min, y_min)), where tile (x, y) is the window
+    array[(y - y_min) * 256:..., (x - x_min) * 256:...].
+    """
+    mercator_bounds = raster.rio.transform_bounds(WEB_MERCATOR)
+    x_min, y_min, x_max, y_max = tile_range(mercator_bounds, z)
+    extent = tile_extent(z)
+    resolution = extent / TILE_SIZE
+
+    transform = Affine(resolution, 0, x_min * extent - ORIGIN,
+                       0, -resolution, ORIGIN - y_min * extent)
+    shape = ((y_max - y_min + 1) * TILE_SIZE, (x_max - x_min + 1) * TILE_SIZE)
+
+    reprojected = raster.squeeze().astype(np.float32).rio.reproject(
+        WEB_MERCATOR, transform=transform, shape=shape, resampling=resampling, nodata=np.nan)
+    return reprojected.values, (x_min, y_min)
+
+
+def downsample_children(children):
+    """Build a parent tile from its four (or fewer) child RGBA tiles
+
+    children maps (dx, dy) in {0, 1}^2 to 256x256x4 arrays; missing
+    children are transparent. Colours are averaged with alpha weighting.
+    """
+    mosaic = np.zeros((2 * TILE_SIZE, 2 * TILE_SIZE, 4), dtype=np.uint8)
+    for (dx, dy), child in children.items():
+        mosaic[dy * TILE_SIZE:(dy + 1) * TILE_SIZE, dx * TILE_SIZE:(dx + 1) * TILE_SIZE] = child
+
+    blocks = mosaic.reshape(TILE_SIZE, 2, TILE_SIZE, 2, 4).astype(np.uint32)
+    alpha = blocks[..., 3]
+    alpha_sum = alpha.sum(axis=(1, 3))
+
+    parent = np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)
+    for channel in range(3):
+        weighted = (blocks[..., channel] * alpha).sum(axis=(1, 3))
+        parent[..., channel] = np.where(alpha_sum > 0, (weighted + alpha_sum // 2) // np.maximum(alpha_sum, 1), 0)
+    parent[..., 3] = (alpha_sum + 2) // 4
+    return parent
+
+
+# -----------------------------------------------------------------------------
+# Tile stores
+# -----------------------------------------------------------------------------
+
+class DirectoryTileStore:
+    """Tiles as {root}/{z}/{x}/{y}.{ext}, with manifest.json alongside"""
+
+    def __init__(self, root, fmt='png'):
+        self.root = Path(root)
+        self.fmt = fmt
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def path(self, z, x, y):
+        return self.root / str(z) / str(x) / f"{y}.{self.fmt}"
+
+    def get(self, z, x, y):
+        path = self.path(z, x, y)
+        return path.read_bytes() if path.exists() else None
+
+    def put(self, z, x, y, data):
+        path = self.path(z, x, y)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+
+    def delete(self, z, x, y):
+        path = self.path(z, x, y)
+        if path.exists():
+            path.unlink()
+
+    def load_manifest(self):
+        path = self.root / 'manifest.json'
+        return json.loads(path.read_text()) if path.exists() else {}
+
+    def save_manifest(self, manifest):
+        (self.root / 'manifest.json').write_text(json.dumps(manifest))
+
+    def close(self):
+        pass
+
+
+class MBTilesStore:
+    """Tiles in an MBTiles SQLite file (TMS row order), manifest in a side table"""
+
+    def __init__(self, path, fmt='png', name='REM'):
+        self.fmt = fmt
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS tiles (zoom_level INTEGER, tile_column INTEGER,
+                                              tile_row INTEGER, tile_data BLOB);
+            CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row);
+            CREATE TABLE IF NOT EXISTS rem_manifest (tile TEXT PRIMARY KEY, hash TEXT);
+        """)
+        self.db.executemany("INSERT OR REPLACE INTO metadata VALUES (?, ?)",
+                            [('name', name), ('format', fmt), ('type', 'overlay')])
+        self.db.commit()
+
+    def get(self, z, x, y):
+        row = self.db.execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+            (z, x, 2 ** z - 1 - y)).fetchone()
+        return row[0] if row else None
+
+    def put(self, z, x, y, data):
+        self.db.execute("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)",
+                        (z, x, 2 ** z - 1 - y, sqlite3.Binary(data)))
+
+    def delete(self, z, x, y):
+        self.db.execute("DELETE FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                        (z, x, 2 ** z - 1 - y))
+
+    def load_manifest(self):
+        return dict(self.db.execute("SELECT tile, hash FROM rem_manifest"))
+
+    def save_manifest(self, manifest):
+        self.db.execute("DELETE FROM rem_manifest")
+        self.db.executemany("INSERT OR REPLACE INTO rem_manifest VALUES (?, ?)", manifest.items())
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+def open_tile_store(output, fmt='png'):
+    """MBTiles store for *.mbtiles paths, directory tree otherwise"""
+    if str(output).endswith('.mbtiles'):
+        return MBTilesStore(output, fmt=fmt)
+    return DirectoryTileStore(output, fmt=fmt)
+
+
+# -----------------------------------------------------------------------------
+# Pyramid generation
+# -----------------------------------------------------------------------------
+
+def _hash(*parts):
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode('utf-8'))
+    return digest.hexdigest()
+
+
+@profiled('build_tile_pyramid')
+def build_tile_pyramid(rem, output, hillshade=None, max_zoom=None, min_zoom=None,
+                       vmin=None, vmax=None, lut=REM_LUT, alpha=200, fmt='png',
+                       n_workers=None, force=False):
+    """Render a z/x/y tile pyramid of the REM (over an optional hillshade)
+
+    rem, hillshade -- georeferenced DataArrays on the same grid
+    output         -- directory, or a path ending in .mbtiles
+    max_zoom       -- defaults to the zoom matching the REM resolution
+    min_zoom       -- defaults to max_zoom - 6
+    force          -- re-render every tile, ignoring the manifest
+
+    Tiles of an earlier run that are no longer produced (e.g. now all-NaN or
+    outside the zoom range) are deleted. Returns a dict with the number of
+    rendered and skipped tiles per zoom, plus the number of 'removed' tiles.
+    """
+    if max_zoom is None:
+        bounds = rem.rio.transform_bounds(WEB_MERCATOR)
+        width = rem.squeeze().shape[-1]
+        max_zoom = zoom_for_resolution((bounds[2] - bounds[0]) / width)
+    if min_zoom is None:
+        min_zoom = max(0, max_zoom - 6)
+
+    rem_grid, (x0, y0) = to_tile_grid(rem, max_zoom)
+    shade_grid = None if hillshade is None else to_tile_grid(hillshade, max_zoom)[0]
+    if vmin is None:
+        vmin = float(np.nanmin(rem_grid))
+    if vmax is None:
+        vmax = float(np.nanmax(rem_grid))
+    params = (vmin, vmax, alpha, fmt, lut.tobytes())
+
+    store = open_tile_store(output, fmt=fmt)
+    old_manifest = store.load_manifest()
+    manifest = {} if force else old_manifest
+    new_manifest = {}
+    stats = {}
+    images = {}   # RGBA of tiles rendered at the previous (finer) level
+
+    # Max zoom - render every tile window in parallel
+    n_rows, n_cols = rem_grid.shape[0] // TILE_SIZE, rem_grid.shape[1] // TILE_SIZE
+
+    def render_tile(row, col):
+        window = np.s_[row * TILE_SIZE:(row + 1) * TILE_SIZE, col * TILE_SIZE:(col + 1) * TILE_SIZE]
+        rem_tile = rem_grid[window]
+        if np.isnan(rem_tile).all():
+            return None
+        shade_tile = None if shade_grid is None else shade_grid[window]
+
+        key = f"{max_zoom}/{x0 + col}/{y0 + row}"
+        tile_hash = _hash(rem_tile.tobytes(), b'' if shade_tile is None else shade_tile.tobytes(), *params)
+        if manifest.get(key) == tile_hash and store.get(max_zoom, x0 + col, y0 + row) is not None:
+            return key, tile_hash, None
+
+        image = render_rem(rem_tile, shade_tile, vmin, vmax, lut=lut, alpha=alpha, transparent=True)
+        return key, tile_hash, image
+
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        tiles = [(row, col) for row in range(n_rows) for col in range(n_cols)]
+        results = [r for r in pool.map(lambda rc: render_tile(*rc), tiles) if r is not None]
+        fresh = [r for r in results if r[2] is not None]
+
+        for (key, _, image), data in zip(fresh, pool.map(lambda r: encode_image(r[2], fmt=fmt.upper()), fresh)):
+            _, x, y = map(int, key.split('/'))
+            store.put(max_zoom, x, y, data)
+            images[(x, y)] = image
+        for key, tile_hash, _ in results:
+            new_manifest[key] = tile_hash
+        stats[max_zoom] = {'rendered': len(fresh), 'skipped': len(results) - len(fresh)}
+
+        # Lower zooms - each parent is the 2x2 downsample of its children
+        level_hashes = {tuple(map(int, key.split('/')[1:])): h for key, h in new_manifest.items()}
+        for z in range(max_zoom - 1, min_zoom - 1, -1):
+            parents = {}
+            for (x, y), child_hash in level_hashes.items():
+                parents.setdefault((x // 2, y // 2), {})[(x % 2, y % 2)] = child_hash
+
+            def build_parent(item):
+                (px, py), child_hashes = item
+                key = f"{z}/{px}/{py}"
+                tile_hash = _hash(*[f"{pos}:{h}" for pos, h in sorted(child_hashes.items())])
+                if manifest.get(key) == tile_hash and store.get(z, px, py) is not None:
+                    return key, tile_hash, None
+
+                children = {}
+                for (dx, dy) in child_hashes:
+                    cx, cy = 2 * px + dx, 2 * py + dy
+                    child = images.get((cx, cy))
+                    if child is None:
+                        child = decode_image(store.get(z + 1, cx, cy))
+                    children[(dx, dy)] = child
+                return key, tile_hash, downsample_children(children)
+
+            results = list(pool.map(build_parent, parents.items()))
+            next_images = {}
+            rendered = skipped = 0
+            level_hashes = {}
+            for key, tile_hash, image in results:
+                _, x, y = map(int, key.split('/'))
+                level_hashes[(x, y)] = tile_hash
+                new_manifest[key] = tile_hash
+                if image is None:
+                    skipped += 1
+                    continue
+                store.put(z, x, y, encode_image(image, fmt=fmt.upper()))
+                next_images[(x, y)] = image
+                rendered += 1
+            images = next_images
+            stats[z] = {'rendered': rendered, 'skipped': skipped}
+
+    stale = [key for key in old_manifest if key not in new_manifest]
+    for key in stale:
+        store.delete(*map(int, key.split('/')))
+    stats['removed'] = len(stale)
+
+    store.save_manifest(new_manifest)
+    store.close()
+    return stats
+
+
+def add_tile_layer(folium_map, tiles_dir, name='REM', max_zoom=None, opacity=1.0, fmt='png'):
+    """Add a z/x/y tile directory written by build_tile_pyramid to a folium map
+
+    tiles_dir is used as the URL prefix, so it must be reachable from the
+    browser (a relative path next to the saved map, or an http URL).
+    """
+    import folium
+
+    kwargs = {} if max_zoom is None else {'max_native_zoom': max_zoom}
+    folium.TileLayer(
+        tiles=f"{str(tiles_dir).rstrip('/')}/{{z}}/{{x}}/{{y}}.{fmt}",
+        attr=name, name=name, overlay=True, control=True, opacity=opacity, **kwargs,
+    ).add_to(folium_map)
+    return folium_map